@@ -15,8 +15,8 @@ sys.path.append(os.path.realpath('../'))
 from util.isochrones import Isochrones
 from util.graphhopper import Graphhopper
 from util.extract_urbancenter import ExtractCenters
-from util.fetch_transitland_gtfs import GtfsDownloader
-from util.extract_osm import extract_osm
+from util.fetch_transitland_gtfs import GtfsDownloader, merge_feeds
+from util.extract_osm import extract_osm, extract_osm_many
 
 # Create a file handler and set the level to DEBUG
 formatter = logging.Formatter('%(asctime)s: %(levelname)-8s %(message)s', datefmt='%Y%m%d,%H:%M:%S')
@@ -40,9 +40,25 @@ logging.info(f"Total cities to be done: {cities.shape[0]}")
 
 # Initialise Graphhopper client.
 CACHE = os.path.join(DROOT, '3-traveltime-cache', 'cache.main.v2.db')
-isochrone_client   = Isochrones(graphhopper_url="http://localhost:8989", db=CACHE, bing_key=os.environ['BING_API_KEY'])
+isochrone_client   = Isochrones(graphhopper_url="http://localhost:8989", db=CACHE, bing_key=os.environ['BING_API_KEY'],
+                                workers=int(os.environ.get('GH_WORKERS', 8)))
 urbancenter_client = ExtractCenters(src_dir=os.path.join(DROOT, '2-external'), target_dir=os.path.join(DROOT, '2-popmasks'), res=1000)
-gtfs_client        = GtfsDownloader(os.environ.get("TRANSITLAND_KEY"))
+gtfs_client        = GtfsDownloader(os.environ.get("TRANSITLAND_KEY"), workers=int(os.environ.get('GTFS_WORKERS', 4)),
+                                    extract_workers=int(os.environ.get('GTFS_EXTRACT_WORKERS', 4)))
+
+# Create OSM extracts of all pending cities up front, in a single pass over the planet file.
+# With OSM_ROUTING_ONLY=1, extracts are cut to the buffered city shape and only keep what's needed for routing.
+# This is off by default, so new cities are routed on the same kind of extracts as those already cached.
+OSM_SRC = os.environ.get('OSM_PLANET_PBF', os.path.join(DROOT, '2-osm', 'src', 'planet-latest.osm.pbf'))
+OSM_ROUTING_ONLY = os.environ.get('OSM_ROUTING_ONLY', '0') == '1'
+osm_path = lambda city_id: os.path.join(DROOT, '2-osm', 'out', f'{int(city_id)}.osm.pbf')
+pending = cities[~((cities.n_req == cities.n_req_ok) & (cities.frac_req_ok == 1.0))]
+pending = pending[[not os.path.exists(osm_path(city_id)) for city_id in pending.city_id]]
+pcl_paths = urbancenter_client.extract_cities(list(zip(pending.city_name, pending.city_id)))
+osm_extracts = [
+    (osm_path(city_id), gpd.GeoDataFrame(pd.read_pickle(pcl_paths[(city_id, 0)])).to_crs('EPSG:4326').unary_union)
+    for city_id in pending.city_id]
+extract_osm_many(OSM_SRC, osm_extracts, buffer_m=20000, polygon=OSM_ROUTING_ONLY, routing_only=OSM_ROUTING_ONLY)
 
 filter = (cities.country_id == 'ESP')
 for pid, city in cities.iterrows():
@@ -57,10 +73,9 @@ for pid, city in cities.iterrows():
     gdf = gpd.GeoDataFrame(pd.read_pickle(pcl_path))
 
     # Create OSM extracts
-    osm_src = os.environ.get('OSM_PLANET_PBF', os.path.join(DROOT, '2-osm', 'src', 'planet-latest.osm.pbf'))
-    osm_out = os.path.join(DROOT, '2-osm', 'out', f'{int(city.city_id)}.osm.pbf')
+    osm_out = osm_path(city.city_id)
     bbox = gdf.to_crs('EPSG:4326').unary_union
-    extract_osm(osm_src, osm_out, bbox, buffer_m=20000)
+    extract_osm(OSM_SRC, osm_out, bbox, buffer_m=20000, polygon=OSM_ROUTING_ONLY, routing_only=OSM_ROUTING_ONLY)
     
     try:
     
@@ -70,10 +85,15 @@ for pid, city in cities.iterrows():
     
         # Fetch GTFS files
         gtfs_client.set_search(bbox.centroid, bbox, 10000)
-        feed_ids = gtfs_client.search_feeds()
+        feed_ids = gtfs_client.search_feeds(cache_path=os.path.join(DROOT, '2-gtfs', 'search', f'{city.city_id}.json'))
         feeds = gtfs_client.download_feeds(feed_ids, os.path.join(DROOT, '2-gtfs'), 
                                            city.city_id, [peak_dt, off_dt])
         
+        # Merge into a single feed for GraphHopper, unless it's up to date with the same extracts.
+        merged = os.path.join(DROOT, '2-gtfs', 'out', f'{city.city_id}-merged.gtfs.zip')
+        if len(feeds) > 0:
+            merge_feeds(feeds, merged)
+        
         # Conditionally fetch transit information. 
         isochrone_config = [
             ('driving_off',        [10, 25], off_dt,  'g'),
@@ -95,16 +115,16 @@ for pid, city in cities.iterrows():
         # Boot Graphhopper instance
         graphhopper = Graphhopper(droot=DROOT, city=city.city_id)
         graphhopper.set_osm(osm_out)
-        graphhopper.set_gtfs(feeds)
+        graphhopper.set_gtfs([merged] if len(feeds) > 0 else [])
         graphhopper.build()
         
         # Try to calibrate example build.
-        sample = gdf.centroid.to_crs('EPSG:4326').sample(15, random_state=10)
-        sample = sample.apply(lambda x: graphhopper.nearest(x))
+        sample = ExtractCenters.centroids(gdf).sample(15, random_state=10)
+        sample = graphhopper.nearest_many(sample)
         graphhopper.calibrate(sample, peak_dt=peak_dt, off_dt=off_dt)
         
-        # Fetch isochrones.
-        points = gdf.centroid.to_crs("EPSG:4326").apply(lambda x: graphhopper.nearest(x))
+        # Fetch isochrones, snapping origins to roads (cached per OSM extract).
+        points = isochrone_client.snap(city.city_id, ExtractCenters.centroids(gdf), osm_out)
         isochrones, (batch_n, batch_n_done, frac_done) = isochrone_client.get_isochrones(
             city_id=city.city_id, 
             points=points,
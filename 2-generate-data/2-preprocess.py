@@ -2,7 +2,12 @@ import pandas as pd
 import geopandas as gpd
 import os
 import sys
+import time
 import datetime
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from shapely.geometry import Polygon
 import logging
 logging.getLogger().setLevel(logging.INFO)
@@ -17,32 +22,42 @@ tqdm.pandas()
 sys.path.append(os.path.realpath('../'))
 from util.isochrones import Isochrones
 from util.extract_urbancenter import ExtractCenters
+from util.reach import compute_reach, compute_reach_raster
+from util.isochrone_store import city_path, write_city
 
 # Start processing cities.
 DROOT = '../1-data/'
-cities = pd.read_csv(os.path.join(DROOT, '1-research', 'cities.latest.csv'))
-# cities = cities[cities.country_id == 'NLD']
+REACH_ENGINE = os.environ.get('REACH_ENGINE', 'vector') # vector (STRtree) or raster (rasterized isochrones)
 CACHE = os.path.join(DROOT, '3-traveltime-cache', 'cache.main.v2.db')
-isochrone_client   = Isochrones(bing_key=os.environ['BING_API_KEY'], db=CACHE)
-urbancenter_client = ExtractCenters(src_dir=os.path.join(DROOT, '2-external'), 
-                                    target_dir=os.path.join(DROOT, '2-popmasks'))
+DATASET = os.path.join(DROOT, '3-traveltime-cities', 'isochrones.parquet')
+
+# Parallelism: cities run in a process pool, admitted while their estimated memory fits the budget.
+WORKERS         = int(os.environ.get('PREPROCESS_WORKERS', os.cpu_count()))
+MEMORY_GB       = float(os.environ.get('PREPROCESS_MEMORY_GB', 32))
+GB_BASE         = 0.5    # Interpreter, population extracts and clients.
+GB_PER_CELL     = 0.002  # Isochrones of 16 configs, their buffers and reach per origin cell.
+
+def estimate_memory(city):
+    """Rough peak memory of preprocessing a city in GB, based on its number of origin cells."""
+    n_cells = city.n_cells if pd.notna(city.n_cells) else 0
+    return GB_BASE + GB_PER_CELL * n_cells
+
+def init_worker():
+    """Creates the clients once per worker process, as connections can't be shared between processes."""
+    global isochrone_client, urbancenter_client
+    logging.getLogger().setLevel(logging.INFO)
+    isochrone_client   = Isochrones(bing_key=os.environ['BING_API_KEY'], db=CACHE)
+    urbancenter_client = ExtractCenters(src_dir=os.path.join(DROOT, '2-external'),
+                                        target_dir=os.path.join(DROOT, '2-popmasks'))
+
+def preprocess_city(city):
+    """Loads a city's isochrones, buffers them, calculates reach and writes them out. Runs in a worker."""
 
-for pid, city in cities.iterrows():
-    
-    
     logging.info(f"Starting {city.city_name} ({city.city_id}) ===")
-    
-    isochrone_pickle_path = os.path.join(DROOT, '3-traveltime-cities', f'{city.city_id}.isochrones.pcl')
-    if os.path.exists(isochrone_pickle_path):
-        logging.info(f"Extract for {city.city_name} already exists, skipping")
-        continue
-    
-    if city.n_req < city.n_req_ok or city.frac_req_ok < 1.0:
-        logging.info(f"Records not complete, skipping.")
-        continue
-    
-    # Extract urban center and read in as pickle
-    pcl_path = urbancenter_client.extract_city(city.city_name, city.city_id)
+
+    # Extract urban center with and without buffer in one read, and read in as pickle
+    pcl_paths = urbancenter_client.extract_cities([(city.city_name, city.city_id)], buffers=[0, 15000])
+    pcl_path = pcl_paths[(city.city_id, 0)]
     gdf = gpd.GeoDataFrame(pd.read_pickle(pcl_path))
     gdf = gdf.rename(columns={'geometry': 'raster'}).set_geometry('raster')
 
@@ -55,53 +70,157 @@ for pid, city in cities.iterrows():
         ('transit_bike_peak',  [15, 30], peak_dt, 'g'),
         ('driving_off',        [10, 25], off_dt,  'g'),
         ('driving_peak',       [10, 25], peak_dt, 'g'),
-        ('cycling',            [15, 30], peak_dt, 'g'), 
+        ('cycling',            [15, 30], peak_dt, 'g'),
         ('walking',            [15, 30], peak_dt, 'g')
     ]
-    
+
     # Fetch including geometry.
     isochrones, (_, _, frac_done) = isochrone_client.get_isochrones(
-        city_id=city.city_id, 
-        points=gdf.centroid.to_crs("EPSG:4326"),
+        city_id=city.city_id,
+        points=ExtractCenters.centroids(gdf),
         config=isochrone_config,
         dry_run=True,
         dry_run_geometry=True,
     )
-    
+
     # Merge raster information in isochrones
     isochrones = isochrones.merge(gdf, left_on='pid', right_index=True)
     isochrones.raster = isochrones.raster.to_crs(isochrones.isochrone.crs)
-    
+
     # Add buffer to isochrones and calculate km2
     isochrones['isochrone']     = isochrones.isochrone.to_crs(isochrones.isochrone.estimate_utm_crs())
     isochrones['isochrone_buf'] = isochrones.isochrone.buffer(300)
     isochrones['isochrone_km2'] = isochrones.isochrone.to_crs(isochrones.isochrone.estimate_utm_crs()).area
     isochrones['isochrone']     = isochrones.isochrone.to_crs('EPSG:4326')
     isochrones['isochrone_buf'] = isochrones.isochrone_buf.to_crs('EPSG:4326')
-    
+
     # Fill empty items and set item types.
     isochrones.isochrone = isochrones.isochrone.fillna(Polygon())
     isochrones.pid = isochrones.pid.astype(str)
-    
+
     # Load in population density from a wider area, not corresponding with the above point_ids.
-    pcl_path = urbancenter_client.extract_city(city.city_name, city.city_id, buffer=15000)
+    pcl_path = pcl_paths[(city.city_id, 15000)]
     pop_gdf = gpd.GeoDataFrame(pd.read_pickle(pcl_path))
     pop_gdf = pop_gdf.rename(columns={'geometry': 'raster'}).set_geometry('raster').to_crs(pop_gdf.estimate_utm_crs())
     pop_gdf['raster_km2'] = pop_gdf.raster.area
     pop_gdf = pop_gdf.to_crs('EPSG:4326')
 
-    # Calculate reach
-    def reach_func(isochrone_buf):
-        reach_bools = pop_gdf.intersects(isochrone_buf)
-        return {
-            'reach_n':   reach_bools.sum(),
-            'reach_km2': pop_gdf[reach_bools].raster_km2.sum(),
-            'reach_pop': pop_gdf[reach_bools].cell_pop.sum(),
-            'reach_geo': pop_gdf[reach_bools].unary_union
-        }
-    reach = isochrones.isochrone_buf.progress_apply(reach_func).apply(pd.Series)
-    
+    # Calculate reach. Reached cells are stored as ids of pop_gdf, util.reach.ReachGeometry dissolves them.
+    if REACH_ENGINE == 'raster':
+        reach = compute_reach_raster(isochrones.isochrone_buf, pcl_path.replace('.pcl', '.tiff'))
+    else:
+        reach = compute_reach(isochrones.isochrone_buf, pop_gdf)
+
     # Append to isochrones and write out
     isochrones = pd.concat([isochrones, reach], axis='columns')
-    isochrones.to_pickle(isochrone_pickle_path)
-    logging.info(isochrones.head(10))
\ No newline at end of file
+    write_city(isochrones, DATASET, city.country_id, city.city_id)
+    logging.info(isochrones.head(10))
+
+    return len(isochrones)
+
+def run_city(city):
+    """Wraps preprocess_city, so one failing city is reported instead of stopping the others."""
+    start = time.monotonic()
+    try:
+        rows = preprocess_city(city)
+        return city.city_id, 'done', rows, time.monotonic() - start
+    except Exception:
+        logging.critical(f"Problem with {city.city_name} ({city.city_id}), continuing with next city.")
+        logging.critical(traceback.format_exc())
+        return city.city_id, 'failed', 0, time.monotonic() - start
+
+if __name__ == "__main__":
+
+    cities = pd.read_csv(os.path.join(DROOT, '1-research', 'cities.latest.csv'))
+    # cities = cities[cities.country_id == 'NLD']
+
+    # Select cities which still have to be done.
+    todo = []
+    for pid, city in cities.iterrows():
+
+        if os.path.exists(city_path(DATASET, city.country_id, city.city_id)):
+            logging.info(f"Extract for {city.city_name} already exists, skipping")
+            continue
+
+        # Cities preprocessed before the Parquet dataset are converted instead of processed again.
+        legacy_path = os.path.join(DROOT, '3-traveltime-cities', f'{city.city_id}.isochrones.pcl')
+        if os.path.exists(legacy_path):
+            logging.info(f"Converting existing pickle of {city.city_name} to the dataset, skipping")
+            legacy = gpd.GeoDataFrame(pd.read_pickle(legacy_path))
+            if 'reach_geo' in legacy.columns:
+                legacy['reach_geo'] = gpd.GeoSeries(legacy.reach_geo, crs='EPSG:4326')
+            write_city(legacy, DATASET, city.country_id, city.city_id)
+            continue
+
+        if city.n_req < city.n_req_ok or city.frac_req_ok < 1.0:
+            logging.info(f"Records for {city.city_name} not complete, skipping.")
+            continue
+
+        todo.append(city)
+    logging.info(f"Preprocessing {len(todo)} cities with {WORKERS} workers and {MEMORY_GB:.0f}GB memory budget.")
+
+    # Extract the population of all cities up front, in one pass over the raster.
+    ExtractCenters(src_dir=os.path.join(DROOT, '2-external'), target_dir=os.path.join(DROOT, '2-popmasks')).extract_cities(
+        [(city.city_name, city.city_id) for city in todo], buffers=[0, 15000], workers=WORKERS)
+
+    # Spawn fresh processes, and replace them after each city so memory is returned.
+    context = multiprocessing.get_context('spawn')
+    make_pool = lambda: ProcessPoolExecutor(max_workers=WORKERS, mp_context=context,
+                                            initializer=init_worker, max_tasks_per_child=1)
+    executor = make_pool()
+
+    # Admit cities in order as long as their estimated memory fits, at least one at a time.
+    # Cities which were running when a worker died are suspects, and are retried one at a time.
+    summary = []
+    running = {}
+    suspects = []
+    isolated = None
+    while todo or suspects or running:
+        if suspects:
+            if not running:
+                city = suspects.pop(0)
+                isolated = executor.submit(run_city, city)
+                running[isolated] = city
+        else:
+            while todo and len(running) < WORKERS:
+                city = todo[0]
+                in_use = sum(estimate_memory(c) for c in running.values())
+                if running and in_use + estimate_memory(city) > MEMORY_GB:
+                    break
+                running[executor.submit(run_city, city)] = todo.pop(0)
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+            # A worker died (e.g. out of memory), which takes down the pool and every city in it.
+            wait(running)
+            done = set(running)
+
+        crashed = []
+        for future in [future for future in running if future in done]:
+            city = running.pop(future)
+            try:
+                summary.append(future.result())
+            except BrokenProcessPool:
+                crashed.append(city)
+        if not crashed:
+            continue
+
+        # Only a city which kills the pool on its own is marked as crashed, others are retried alone.
+        if len(crashed) == 1 and isolated in done:
+            city = crashed[0]
+            logging.critical(f"Worker died while preprocessing {city.city_name} ({city.city_id}) on its own, skipping.")
+            summary.append((city.city_id, 'crashed', 0, float('nan')))
+        else:
+            logging.critical(f"Worker died while preprocessing {', '.join(str(c.city_id) for c in crashed)}, "
+                             f"retrying them one at a time.")
+            suspects = crashed + suspects
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = make_pool()
+    executor.shutdown()
+
+    # Write out timings.
+    summary = pd.DataFrame(summary, columns=['city_id', 'status', 'rows', 'seconds'])
+    summary = summary.merge(cities[['city_id', 'city_name', 'n_cells']], on='city_id', how='left')
+    logging.info(f"Preprocessing summary:\n{summary.sort_values('seconds', ascending=False).to_string(index=False)}")
+    logging.info(f"{(summary.status == 'done').sum()} done, {(summary.status != 'done').sum()} failed, "
+                 f"{summary.seconds.sum() / 60:.1f} worker-minutes in total.")
@@ -17,25 +17,26 @@ tqdm.pandas()
 sys.path.append(os.path.realpath('../'))
 from util.isochrones import Isochrones
 from util.extract_urbancenter import ExtractCenters
+from util.isochrone_store import city_path, combine
 
 # Start processing cities.
 DROOT = '../1-data/'
 cities = pd.read_excel(os.path.join(DROOT, '1-research', 'cities.latest.xlsx'))
+DATASET = os.path.join(DROOT, '3-traveltime-cities', 'isochrones.parquet')
 CACHE = os.path.join(DROOT, '3-traveltime-cache', 'cache.main.v2.db')
 isochrone_client   = Isochrones(bing_key=os.environ['BING_API_KEY'], db=CACHE)
 urbancenter_client = ExtractCenters(src_dir=os.path.join(DROOT, '2-external'), 
                                     target_dir=os.path.join(DROOT, '2-popmasks'))
 
-isochrones_together = []
+# Stream all existing cities into one file, skipping the ones unchanged since the last export.
+sources = []
 for pid, city in cities.iterrows():
     
-    isochrone_pickle_path = os.path.join(DROOT, '3-traveltime-cities', f'{city.city_id}.isochrones.pcl')
-    if not os.path.exists(isochrone_pickle_path):
+    isochrone_path = city_path(DATASET, city.country_id, city.city_id)
+    if not os.path.exists(isochrone_path):
         logging.warning(f"Isochrones for {city.city_name} ({city.city_id}) do not exist, skipping.")
         continue
     
-    logging.info(f"Loading {city.city_name} ({city.city_id})...")
-    isochrones_together.append(pd.read_pickle(isochrone_pickle_path))
+    sources.append((city.country_id, city.city_id, isochrone_path))
     
-isochrones = pd.concat(isochrones_together)
-isochrones.to_pickle(os.path.join(DROOT, '3-traveltime-cities', f'latest.isochrones.pcl'))
\ No newline at end of file
+combine(sources, os.path.join(DROOT, '3-traveltime-cities', f'latest.isochrones.parquet'))
\ No newline at end of file
@@ -3,21 +3,25 @@ import os.path
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-import json
-from shapely.geometry import shape
+import shapely
+from concurrent.futures import ProcessPoolExecutor
 
 import rasterio
 from rasterio.mask import mask
-from rasterio.features import shapes
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
 
 import logging
+from tqdm import tqdm
 
 class ExtractCenters:
     
-    def __init__(self, src_dir, target_dir, res = 1000):
+    def __init__(self, src_dir, target_dir, res = 1000, lazy = True):
         self.src_dir = src_dir
         self.target_dir = target_dir
         self.res = res
+        self.lazy = lazy
         self.initialised = False
         
         assert self.res == 1000 or self.res == 100
@@ -40,45 +44,71 @@ class ExtractCenters:
             logging.info(f"{os.path.exists(urbancenter_path)}: {urbancenter_path}")
             raise FileExistsError()
         
+        # Opening only reads the header, masking later reads just the window around a city.
         logging.info("Initialising population raster..")
         self.pop = rasterio.open(pop_path)
+        self.urbancenter_path = urbancenter_path
         
-        logging.info("Initialising urban_center raster..")
-        self.urbancenter_gdf = gpd.read_file(urbancenter_path).to_crs(self.pop.crs)
+        # In lazy mode, urban centers are read one by one when needed.
+        if not self.lazy:
+            logging.info("Initialising urban_center raster..")
+            self.urbancenter_gdf = gpd.read_file(urbancenter_path).to_crs(self.pop.crs)
         
+        self.initialised = True
         return 0
+    
+    def _get_centers(self, city_ids):
+        """Gets the urban centers of cities in the raster's CRS, only reading those features in lazy mode."""
+        if self.lazy:
+            ids = ', '.join(str(int(city_id)) for city_id in city_ids)
+            center_gdf = gpd.read_file(self.urbancenter_path, where=f"ID_HDC_G0 IN ({ids})")
+            return center_gdf.to_crs(self.pop.crs)
+        return self.urbancenter_gdf[self.urbancenter_gdf.ID_HDC_G0.isin(city_ids)]
         
-    def _mask_raster_to_tiff(self, gdf_entry, raster, tiff_out):
-        """Takes raster, masking it using a gpd dataframe and writes to a TIFF out.
+    def _paths(self, city_id, buffer):
+        """Paths of the GeoTIFF and pickle extracts of a city with a buffer."""
+        name = f"{city_id}.buf{buffer}.res{self.res}"
+        return os.path.join(self.target_dir, f"{name}.tiff"), os.path.join(self.target_dir, f"{name}.pcl")
+
+    def _mask_raster(self, geometries, raster):
+        """Reads the raster window covering all geometries once, then masks and crops it per geometry in memory.
 
         Args:
-            gdf_entry (GeoDataFrame): Used as mask for raster
-            raster (Path): Path to a RasterIO tiff file
-            tiff_out (Path): to write the out-tiff
+            geometries (list): Shapely geometries in the raster CRS, the last one covering the others.
+            raster (DatasetReader): Opened RasterIO dataset.
+
+        Returns:
+            list: Tuples of (image, transform), one per geometry.
         """
+        # With crop, only the window covering the shapes is read from the raster.
+        image, transform = mask(dataset=raster, shapes=[geometries[-1]], crop=True)
+        image = image[0]
     
-        out_img, out_transform = mask(
-            dataset=raster, 
-            shapes=self._get_mask_coords(gdf_entry), 
-            crop=True)
+        results = []
+        for geometry in geometries:
+            inside = geometry_mask([geometry], out_shape=image.shape, transform=transform, invert=True)
+            rows, cols = np.nonzero(inside.any(axis=1))[0], np.nonzero(inside.any(axis=0))[0]
+            if len(rows) == 0:
+                rows, cols = np.array([0]), np.array([0])
+
+            window = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+            cropped = np.where(inside, image, raster.nodata).astype(image.dtype)[window.toslices()]
+            results.append((cropped, window_transform(window, transform)))
+        return results
 
-        # Write out for usage a bit further onwards due to limitations in rasterio.
+    def _write_tiff(self, image, transform, tiff_out):
+        """Writes a masked population image to a GeoTIFF, as used by the raster reach engine."""
         out_meta = self.pop.meta.copy()
         out_meta.update({
             "driver": "GTiff",
-            "height": out_img.shape[1],
-            "width": out_img.shape[2],
-            "transform": out_transform,
+            "height": image.shape[0],
+            "width": image.shape[1],
+            "transform": transform,
             "crs": self.pop.crs
         })
 
         with rasterio.open(tiff_out, "w", **out_meta) as dest:
-            dest.write(out_img)
-        
-    # Convert single GeoDataFrame Polygon to GeoJSON
-    def _get_mask_coords(self, gdf): 
-        """Get the first polygon in a GeoDataFrame as GeoJSON."""
-        return [json.loads(gdf.to_json())['features'][0]['geometry']]
+            dest.write(image, 1)
         
     def extract_city(self, city_name, city_id, buffer=0):
         """Creates GeoDataFrames and GeoTIFF extracts from Population Rasters. 
@@ -88,56 +118,134 @@ class ExtractCenters:
             city_id (_type_): _description_
             buffer (integer): adds meters of buffer around zone.
         """
+        return self.extract_cities([(city_name, city_id)], buffers=[buffer])[(city_id, buffer)]
         
-        # Paths
-        tiff_path = os.path.join(self.target_dir, f"{city_id}.buf{buffer}.res{self.res}.tiff")
-        pcl_path  = os.path.join(self.target_dir, f"{city_id}.buf{buffer}.res{self.res}.pcl")
+    def extract_cities(self, cities, buffers=(0,), workers=1):
+        """Creates population extracts for many cities and buffers, reading the raster once per city.
         
-        # Log, and if city already done, skip this.
-        if(os.path.exists(tiff_path) and os.path.exists(pcl_path)):
-            logging.debug(f"Population raster extract already exists: {city_name} ({city_id}.buf{buffer}.res{self.res})")
-            return pcl_path
-        else:
-            logging.info(f"Creating population extract for city: {city_name} ({city_id}.buf{buffer}.res{self.res})")
+        Only missing extracts are created, existing ones are never rewritten. The raster
+        window around a city's largest missing buffer is read once, all its missing
+        buffers are masked from it in memory. Cities are handled in order of the raster
+        block they start in, so neighbouring reads hit the same blocks. With several
+        workers, contiguous runs of that order are extracted in separate processes.
+
+        Args:
+            cities (list): Tuples of (city_name, city_id).
+            buffers (list): Meters of buffer around the zone, one extract per buffer. Defaults to (0,).
+            workers (int): Processes to extract with. Defaults to 1.
+
+        Returns:
+            dict: Pickle path per (city_id, buffer).
+        """
+        buffers = sorted(set(buffers))
+        paths = {(city_id, buffer): self._paths(city_id, buffer)[1] for _, city_id in cities for buffer in buffers}
+
+        # Log, and skip extracts which are already done. Existing extracts are never rewritten, as
+        # pickles written before row-major cell order would change the cells behind cached pids.
+        todo = []
+        for city_name, city_id in cities:
+            missing = [buffer for buffer in buffers
+                       if not all(os.path.exists(p) for p in self._paths(city_id, buffer))]
+            if len(missing) > 0:
+                todo.append((city_name, city_id, missing))
+        if len(todo) == 0:
+            logging.debug(f"Population raster extracts already exist for {len(cities)} cities (buffers {buffers}, res{self.res})")
+            return paths
+        logging.info(f"Creating population extracts for {len(todo)} cities (buffers {buffers}, res{self.res})")
         
         # Only initialise rasters if we know we have to do some work, e.g., now.
         if not self.initialised:
             self._load_rasters()
         
-        # Write out a masked selection with city population.
-        center_gdf = self.urbancenter_gdf[self.urbancenter_gdf.ID_HDC_G0 == city_id]
-        center_gdf = center_gdf.to_crs(center_gdf.estimate_utm_crs()).buffer(buffer).to_crs(center_gdf.crs)
-        self._mask_raster_to_tiff(
-            gdf_entry=center_gdf,
-            raster=self.pop,
-            tiff_out=tiff_path
-        )
-        
-        # Convert the masked tiff to geojson for GeoPandas to use.
-        # This is doing the heavy lifting!
-        with rasterio.open(tiff_path) as raster:
-            image = raster.read(1).astype("float32")
-            
-            # Add tiny random deviation (<1) so units don't join together
-            #   in the next shapes() method. 
-            rand_add = np.random.random(image.shape)
-            rand_add[image == -200] = 0
-            image += rand_add
-            
-            crs = raster.crs
-            list_pop = [
-                {'cell_pop': value, 'geometry': shape(shp)}
-                for i, (shp, value) 
-                in enumerate(shapes(image, transform=raster.transform))
-                if value > raster.nodata
-            ]
-        
-        # Read in as a GeoPandas dataset and write out. 
-        gdf_pop = gpd.GeoDataFrame(list_pop, crs=crs)
-        gdf_pop.cell_pop = np.maximum(gdf_pop.cell_pop, 0)
-        gdf_pop.to_pickle(pcl_path)
-        
-        return pcl_path
+        # Read all urban centers at once, and buffer them.
+        center_gdf = self._get_centers([city_id for _, city_id, _ in todo]).set_index('ID_HDC_G0')
+        not_found = set(city_id for _, city_id, _ in todo) - set(center_gdf.index)
+        assert len(not_found) == 0, f"Urban centers {not_found} not found."
+        
+        jobs = []
+        for city_name, city_id, missing in todo:
+            center = center_gdf.loc[[city_id]].geometry
+            center_utm = center.to_crs(center.estimate_utm_crs())
+            geometries = [center_utm.buffer(buffer).to_crs(center.crs).iloc[0] for buffer in missing]
+            jobs.append((city_name, city_id, geometries, missing))
+        
+        # Sort by the raster block holding the top-left corner of the largest buffer.
+        block_height, block_width = self.pop.block_shapes[0]
+        def block(job):
+            minx, _, _, maxy = job[2][-1].bounds
+            col, row = ~self.pop.transform * (minx, maxy)
+            return int(row) // block_height, int(col) // block_width
+        jobs.sort(key=block)
+        
+        if workers <= 1:
+            _extract_jobs(self, jobs)
+            return paths
+
+        # Every process opens the raster itself, as datasets can't be shared between processes.
+        workers = min(workers, len(jobs))
+        chunks = [jobs[len(jobs) * i // workers:len(jobs) * (i + 1) // workers] for i in range(workers)]
+        clients = [ExtractCenters(self.src_dir, self.target_dir, res=self.res) for _ in chunks]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_extract_jobs, clients, chunks))
+
+        return paths
+
+    def _extract_job(self, city_name, city_id, geometries, buffers):
+        """Extracts the given buffers of one city, writing the GeoTIFF and pickle of each which don't exist yet."""
+        logging.debug(f"Creating population extract for city: {city_name} ({city_id}, buffers {buffers})")
+
+        for buffer, (image, transform) in zip(buffers, self._mask_raster(geometries, self.pop)):
+            tiff_path, pcl_path = self._paths(city_id, buffer)
+            if not os.path.exists(tiff_path):
+                self._write_tiff(image, transform, tiff_path)
+
+            # Convert the masked image to one box per cell for GeoPandas to use, and write out.
+            if not os.path.exists(pcl_path):
+                gdf_pop = self.cells_from_raster(image, transform, self.pop.nodata, self.pop.crs)
+                gdf_pop.to_pickle(pcl_path)
+    
+    @staticmethod
+    def cells_from_raster(image, transform, nodata, crs):
+        """Builds a GeoDataFrame with a box per raster cell holding data, straight from the transform.
+        
+        Cells are in row-major order, so their index is the position among valid cells 
+        of the raster. Populations are exact, negative values are set to 0.
+
+        Args:
+            image (ndarray): 2D population raster.
+            transform (Affine): Transform of the (north-up) raster.
+            nodata (float): Nodata value, cells equal or below it are left out.
+            crs (CRS): CRS of the raster.
+        
+        Returns:
+            GeoDataFrame: Columns cell_pop, row, col and the cell geometry.
+        """
+        rows, cols = np.nonzero(image > nodata)
+        xmin = transform.c + cols * transform.a
+        ymax = transform.f + rows * transform.e
+        cells = shapely.box(xmin, ymax + transform.e, xmin + transform.a, ymax)
+        
+        return gpd.GeoDataFrame({
+            'cell_pop': np.maximum(image[rows, cols].astype('float32'), 0),
+            'row': rows.astype('int32'),
+            'col': cols.astype('int32'),
+        }, geometry=cells, crs=crs)
+    
+    @staticmethod
+    def centroids(gdf, crs='EPSG:4326'):
+        """Centers of grid cells as points, e.g. as isochrone origins, calculated from their bounds."""
+        bounds = gdf.geometry.bounds
+        points = gpd.GeoSeries(gpd.points_from_xy((bounds.minx + bounds.maxx) / 2, (bounds.miny + bounds.maxy) / 2),
+                               index=gdf.index, crs=gdf.crs)
+        return points.to_crs(crs)
+
+def _extract_jobs(client, jobs):
+    """Runs a list of extract jobs on a client, in a worker process or the current one."""
+    if not client.initialised:
+        client._load_rasters()
+    for city_name, city_id, geometries, buffers in tqdm(jobs, desc='Extracting population'):
+        client._extract_job(city_name, city_id, geometries, buffers)
+    return len(jobs)
 
 if __name__ == "__main__":
 
@@ -151,9 +259,8 @@ if __name__ == "__main__":
     urbancenter_client = ExtractCenters(src_dir=os.path.join(droot, '2-external'), 
                                         target_dir=os.path.join(droot, '2-popmasks'))
 
-    # Get masked population dataframes for all mentioned cities.
-    for city in city_list_df.itertuples():
-        urbancenter_client.extract_city(
-            city_name=city.City, 
-            city_id=city.city_id, 
-            buffer=0)
\ No newline at end of file
+    # Get masked population dataframes for all mentioned cities, with the buffers used in preprocessing.
+    urbancenter_client.extract_cities(
+        cities=list(zip(city_list_df.City, city_list_df.city_id)),
+        buffers=[0, 15000],
+        workers=int(os.environ.get('EXTRACT_WORKERS', 4)))
@@ -1,18 +1,253 @@
 import datetime
 import os
+import sys
+import json
+import hashlib
+import time
+import queue
+import io
+import zipfile
 import traceback
+import multiprocessing
+import shutil
+from glob import glob
 from shapely.geometry import Point, Polygon
+import requests
 import pandas as pd
 import geopandas as gpd
-import requests
 import gtfs_kit as gk
 import logging
 import numpy as np
 
+# Import custom libraries
+sys.path.append(os.path.realpath('../'))
+from util.session import make_session
+from util.pool import imap_bounded
+from util.gtfs_trim import index_feed, cut_feed, _members, _read
+
+# Tables taken over when merging feeds, and the id columns which are namespaced per feed.
+MERGE_TABLES = ['agency', 'stops', 'routes', 'trips', 'stop_times', 'calendar', 'calendar_dates', 
+                'shapes', 'frequencies', 'transfers']
+ID_COLUMNS = ['agency_id', 'stop_id', 'parent_station', 'route_id', 'trip_id', 'service_id', 'shape_id', 
+              'block_id', 'level_id', 'from_stop_id', 'to_stop_id', 'from_route_id', 'to_route_id', 
+              'from_trip_id', 'to_trip_id']
+FEED_INFO = {'feed_publisher_name': 'UrbanTransportTimes', 
+             'feed_publisher_url': 'https://github.com/idegeus/UrbanTransportTimes', 
+             'feed_lang': 'mul'}
+
+def index_source_feed(gtfs_in, feed_id, index_dir, datefilter_str):
+    """Indexes a source feed for the dates once per feed version, removing indices of older versions.
+
+    Args:
+        gtfs_in (path): Source GTFS zip.
+        feed_id (str): Transitland Onestop id.
+        index_dir (path): Directory holding the indices of all feeds.
+        datefilter_str (list): Dates as YYYYMMDD strings.
+
+    Returns:
+        path: Directory of the index, see util.gtfs_trim.index_feed.
+    """
+    # The version is the sha1 recorded on download, or the modification time for feeds without.
+    meta_path = gtfs_in.replace('.gtfs.zip', '.gtfs.json')
+    meta = json.load(open(meta_path, 'r')) if os.path.exists(meta_path) else {}
+    version = (meta.get('sha1') or hashlib.sha1(str(os.stat(gtfs_in).st_mtime_ns).encode()).hexdigest())[:12]
+    dates = '_'.join(sorted(set(datefilter_str)))
+    index_path = os.path.join(index_dir, f'{feed_id}-{version}-{dates}')
+    
+    for stale in glob(os.path.join(index_dir, f"{feed_id}-{'?' * 12}-{dates}")):
+        if stale != index_path:
+            logging.info(f"Removing index of an older version of {feed_id}: {stale}")
+            shutil.rmtree(stale)
+    
+    return index_feed(gtfs_in, index_path, sorted(set(datefilter_str)))
+
+def extract_feed(feed_id, gtfs_in, gtfs_out, index_dir, area, datefilter_str, force_extr=False):
+    """Creates a city's extract of a source feed, cut to an area and dates, with recreated shapes.
+
+    Args:
+        feed_id (str): Transitland Onestop id.
+        gtfs_in (path): Source GTFS zip.
+        gtfs_out (path): Extract to write.
+        index_dir (path): Directory holding the indices of all feeds.
+        area (GeoDataFrame): Area in EPSG:4326, trips stopping within it are kept.
+        datefilter_str (list): Dates as YYYYMMDD strings.
+        force_extr (bool, optional): Recreate the extract if it exists. Defaults to False.
+
+    Returns:
+        path: gtfs_out if the extract is usable, otherwise None.
+    """
+    
+    # Check if it already exists, if so, read in (if needed) and skip.
+    try:
+        if os.path.exists(gtfs_out) and not force_extr:
+            logging.debug(f"Already extracted: {feed_id}")
+            newfeed = gk.read_feed(gtfs_out, dist_units='km')
+        else:
+            # Cut bounding box and dates from the feed's index, shared by all cities, then read the small result with gtfs-kit.
+            logging.info(f"Creating GTFS extract at {gtfs_out}. (force_extr={str(force_extr)})")
+            index_path = index_source_feed(gtfs_in, feed_id, index_dir, datefilter_str)
+            gtfs_trimmed = os.path.join(os.path.dirname(gtfs_out), '_' + os.path.basename(gtfs_out))
+            if cut_feed(index_path, gtfs_trimmed, area) == 0:
+                logging.info(f"Not adding {feed_id}, no trips stop within bbox.")
+                return None
+            newfeed = gk.read_feed(gtfs_trimmed, dist_units='km')
+            os.remove(gtfs_trimmed)
+            
+            logging.debug("Recreating shapes.")
+            newfeed = newfeed.create_shapes(all_trips=True) # Recreate shapes for accuracy.
+            
+            logging.debug("Fixing zombies.")
+            # newfeed = newfeed.drop_zombies()
+            
+            logging.debug("Fixing stops.")
+            # Drop stops with NaN as stop_id if there is more than one.
+            # if newfeed.stops.stop_id.isna().sum() == 1:
+            #     print("renaming the bastard")
+            #     newfeed.stop_times.stop_id = newfeed.stop_times.stop_id.fillna("tmp_stop_id")
+            #     newfeed.stops.stop_id = newfeed.stops.stop_id.fillna("tmp_stop_id")
+            if newfeed.stops.stop_id.isna().sum() >= 1:
+                logging.warning("Dropping the bastards")
+                newfeed.stop_times = newfeed.stop_times[newfeed.stop_times.stop_id.notna()]
+                newfeed.stops = newfeed.stops[newfeed.stops.stop_id.notna()]
+            
+            logging.debug("Writing out.")
+            newfeed.write(gtfs_out)
+        
+    # Sometimes there's a read error. 
+    except pd.errors.ParserError:
+        logging.warning(f'Not adding {feed_id}, bad feed, read exception. Continuing without...')
+        logging.warning(traceback.format_exc())
+        return None
+    
+    # Check for validity. 
+    if not (isinstance(newfeed.routes, pd.DataFrame) 
+            and isinstance(newfeed.stops, pd.DataFrame)
+            and isinstance(newfeed.trips, pd.DataFrame)):
+        logging.info(f"Feed {feed_id} was empty. This can be because nothing was within bbox.")
+        return None
+    
+    logging.debug(f'===== Feed {feed_id} after restrictions.')
+    logging.debug(f'Routes: {newfeed.routes.shape}')
+    logging.debug(f'Stops: {newfeed.stops.shape}')
+    logging.debug(f'Trips: {newfeed.trips.shape}')
+    logging.debug(newfeed.routes.head(10))
+    
+    # If good, add to feed list.
+    if (newfeed.stops.shape[0] > 0 and newfeed.trips.shape[0] > 0):
+        logging.info(f"Appending feed {feed_id} correctly.")
+        return gtfs_out
+    return None
+
+def _run_extract_feed(results_queue, level, job):
+    """Runs extract_feed() in a worker process, reporting the result or None on any error."""
+    logging.getLogger().setLevel(level)
+    try:
+        results_queue.put((job[0], extract_feed(*job)))
+    except Exception:
+        logging.warning(f"Not adding {job[0]}, extraction failed. Continuing without...")
+        logging.warning(traceback.format_exc())
+        results_queue.put((job[0], None))
+
+def _namespace(table, prefix, agency_id):
+    """Prefixes all id columns of a chunk, leaving empty ids empty, and fills in missing agency ids."""
+    for column in table.columns.intersection(ID_COLUMNS):
+        table[column] = table[column].where(table[column] == '', prefix + table[column])
+    if agency_id is not None and 'agency_id' in table.columns:
+        table['agency_id'] = table['agency_id'].replace('', agency_id)
+    return table
+
+def merge_feeds(feed_paths, out_path, feed_info_path=None, chunksize=1000000, force=False):
+    """Merges GTFS feeds into one zip, streaming every table, so GraphHopper loads a single feed.
+
+    Ids are prefixed per feed (f0_, f1_, ..) so they can't collide between feeds. 
+    Every table is written with the union of the columns of all feeds, chunk by chunk,
+    without holding a whole feed in memory. Agencies without an agency_id get one, 
+    and routes without one are assigned to it. A single feed_info replaces those of
+    the feeds, read from feed_info_path if given, otherwise generated.
+
+    The merged feeds are listed in a sidecar JSON next to the zip. An existing merge
+    is kept if it was made from the same feeds and none of them changed since.
+
+    Args:
+        feed_paths (list): Paths of the GTFS zips to merge, e.g. as returned by download_feeds.
+        out_path (path): Merged GTFS zip to write.
+        feed_info_path (path, optional): CSV to use as feed_info.txt, e.g. feed_info.template.csv.
+        chunksize (int): Rows per chunk. Defaults to 1000000.
+        force (bool): Merge even if the existing merge is up to date. Defaults to False.
+
+    Returns:
+        path: out_path.
+    """
+    assert len(feed_paths) > 0
+    
+    # Skip if the existing merge has the same feeds, and is newer than all of them.
+    meta_path = out_path.replace('.gtfs.zip', '.gtfs.json')
+    sources = [os.path.abspath(path) for path in feed_paths]
+    meta = json.load(open(meta_path, 'r')) if os.path.exists(meta_path) and os.path.exists(out_path) else {}
+    if (not force and meta.get('feeds') == sources 
+            and os.path.getmtime(out_path) >= max(os.path.getmtime(path) for path in feed_paths)):
+        logging.debug(f"Merged feed is up to date: {out_path}")
+        return out_path
+    
+    zips = [zipfile.ZipFile(path) for path in feed_paths]
+    members = [_members(zf) for zf in zips]
+    prefixes = [f'f{i}_' for i in range(len(feed_paths))]
+
+    # Agency id to fill in per feed, for feeds which leave it out.
+    agency_ids = []
+    for zf, names, prefix in zip(zips, members, prefixes):
+        agency = _read(zf, names, 'agency.txt')
+        if agency is None or len(agency) == 0:
+            agency_ids.append(None)
+        elif 'agency_id' not in agency.columns or (agency.agency_id == '').all():
+            agency_ids.append(prefix + 'agency')
+        else:
+            agency_ids.append(prefix + agency.agency_id[agency.agency_id != ''].iloc[0])
+
+    tmp_path = os.path.join(os.path.dirname(out_path), '_' + os.path.basename(out_path))
+    with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as out:
+        for name in MERGE_TABLES:
+            
+            # Union of the columns, only reading the headers.
+            headers = [_read(zf, names, f'{name}.txt', nrows=0) for zf, names in zip(zips, members)]
+            if all(header is None for header in headers):
+                continue
+            columns = list(dict.fromkeys(c for header in headers if header is not None for c in header.columns))
+            if name in ['agency', 'routes'] and any(agency_ids):
+                columns = list(dict.fromkeys(columns + ['agency_id']))
+            
+            with out.open(f'{name}.txt', 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+                pd.DataFrame(columns=columns).to_csv(f, index=False)
+                for zf, names, prefix, agency_id, header in zip(zips, members, prefixes, agency_ids, headers):
+                    if header is None:
+                        continue
+                    for chunk in _read(zf, names, f'{name}.txt', chunksize=chunksize):
+                        chunk = _namespace(chunk.reindex(columns=columns, fill_value=''), prefix, agency_id)
+                        chunk.to_csv(f, index=False, header=False)
+            logging.debug(f"Merged {name}.txt of {sum(h is not None for h in headers)} feeds.")
+        
+        # One feed_info for the merged feed, as some feeds lack it, which GraphHopper needs.
+        feed_info = pd.read_csv(feed_info_path, dtype=str) if feed_info_path else pd.DataFrame([FEED_INFO])
+        with out.open('feed_info.txt', 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+            feed_info.to_csv(f, index=False)
+    
+    for zf in zips:
+        zf.close()
+    os.replace(tmp_path, out_path)
+    json.dump({'feeds': sources, 'merged_at': datetime.datetime.now().isoformat()}, open(meta_path, 'w'), indent=1)
+    
+    logging.info(f"Merged {len(feed_paths)} feeds into {out_path} ({os.path.getsize(out_path) / 1e6:.1f}MB)")
+    return out_path
+
 class GtfsDownloader:
     
-    def __init__(self, tl_key):
+    def __init__(self, tl_key, workers=4, tl_url='https://transit.land/api/v2/rest', extract_workers=1, extract_timeout=1800):
         self.tl_key = tl_key
+        self.tl_url = tl_url
+        self.workers = workers
+        self.extract_workers = extract_workers
+        self.extract_timeout = extract_timeout
+        self.session = make_session(pool_size=workers)
         
     def set_search(self, point, bbox, radius=10000):
         """Set search info for downloading GTFS files
@@ -37,31 +272,177 @@ class GtfsDownloader:
         bbox_gdf.geometry = bbox_gdf.to_crs(bbox_gdf.estimate_utm_crs()).buffer(5000).to_crs(bbox_gdf.crs)
         self.bbox_gdf = bbox_gdf
         
-    def search_feeds(self):
+    def search_feeds(self, cache_path=None, max_age=datetime.timedelta(weeks=1)):
+        """Searches Transitland for feeds of agencies operating around the set point.
+
+        Args:
+            cache_path (path, optional): JSON file to cache the result in, e.g. per city. Reused 
+                if the search parameters are the same and it's younger than max_age.
+            max_age (timedelta): Maximum age of a cached result. Defaults to one week.
+
+        Returns:
+            list: Transitland Onestop ids of the feeds.
+        """
+        
+        # Reuse an earlier search for the same area.
+        params = {"lat": self.point.y, "lon": self.point.x, "radius": self.radius}
+        if cache_path is not None and os.path.exists(cache_path):
+            cached = json.load(open(cache_path, 'r'))
+            fetched_at = datetime.datetime.fromisoformat(cached['fetched_at'])
+            if cached['params'] == params and fetched_at > datetime.datetime.now() - max_age:
+                logging.info(f"Using {len(cached['feed_ids'])} feeds found on {fetched_at:%Y-%m-%d} from {cache_path}")
+                return cached['feed_ids']
         
         # Fetch agencies operating in the area around the constructed centroid. 
         logging.info(f"Fetching agencies & trips {self.radius} meters around {str(self.point)}.")
-        url = 'https://transit.land/api/v2/rest/agencies'
-        params = {
-            "lat": self.point.y,
-            "lon": self.point.x,
-            "radius": self.radius,
-            "apikey": self.tl_key
-        }
-        res = requests.get(url, params=params).json()
+        url = f'{self.tl_url}/agencies'
+        res = self.session.get(url, params=params | {"apikey": self.tl_key}).json()
         agencies = res['agencies'] if 'agencies' in res else []
         
         # Fetch more records.
         while 'meta' in res and 'next' in res.get('meta', {}):
-            res = requests.get(res['meta']['next']).json()
+            res = self.session.get(res['meta']['next']).json()
             agencies += res['agencies']
         
         # Filter the TransitLand One-IDs for each suggested feed from agencies operating there. 
         feeds = [agency['feed_version'] for agency in agencies]
-        feed_ids = list(set([feed['feed']['onestop_id'] for feed in feeds]))
+        feed_ids = sorted(set([feed['feed']['onestop_id'] for feed in feeds]))
         logging.info(f"Fetched {len(feed_ids)} relevant feeds {str(feed_ids)}")
         
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            json.dump({'params': params, 'fetched_at': datetime.datetime.now().isoformat(), 
+                       'feed_ids': feed_ids}, open(cache_path, 'w'), indent=1)
+        
         return feed_ids
+    
+    def _download_feed(self, gtfs_in, feed_id, max_age=datetime.timedelta(weeks=1), force=False):
+        """Downloads the latest version of a feed to gtfs_in, streaming it to disk.
+
+        Freshness is kept in a sidecar JSON next to the feed. Feeds checked less than 
+        max_age ago are skipped, older ones are requested with their ETag and 
+        Last-Modified, so an unchanged feed isn't transferred again.
+
+        Args:
+            gtfs_in (path): Destination path of the zip.
+            feed_id (str): Transitland Onestop id.
+            max_age (timedelta): Time after which a feed is checked again. Defaults to one week.
+            force (bool): Download even if the local feed is recent. Defaults to False.
+
+        Returns:
+            str: 'recent', 'unchanged', 'downloaded' or 'failed'.
+        """
+        meta_path = gtfs_in.replace('.gtfs.zip', '.gtfs.json')
+        meta = json.load(open(meta_path, 'r')) if os.path.exists(meta_path) and os.path.exists(gtfs_in) else {}
+        now = datetime.datetime.now()
+        
+        # Check for recency (less than one week old)
+        if meta and not force and datetime.datetime.fromisoformat(meta['checked_at']) > now - max_age:
+            logging.debug(f"Skipping already recently downloaded {feed_id}")
+            return 'recent'
+        
+        # Ask the server to only send the feed if it changed.
+        headers = {}
+        if meta and not force:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        
+        url = f"{self.tl_url}/feeds/{feed_id}/download_latest_feed_version"
+        try:
+            with self.session.get(url, params={"apikey": self.tl_key}, headers=headers, stream=True) as response:
+                if not response.ok and response.status_code != 304:
+                    logging.warning(f"Could not download {feed_id}: {response.status_code} {response.reason}")
+                    return 'failed'
+                elif response.status_code == 304:
+                    logging.debug(f"Feed {feed_id} not modified since {meta.get('last_modified')}")
+                    status = 'unchanged'
+                else:
+                    logging.info(f"Downloading {gtfs_in} (force_dl={str(force)})")
+                
+                    # Stream to a partial file in chunks, hashing on the way, and only then replace the old feed.
+                    sha1 = hashlib.sha1()
+                    with open(gtfs_in + '.part', 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=1024 * 1024):
+                            f.write(chunk)
+                            sha1.update(chunk)
+                    os.replace(gtfs_in + '.part', gtfs_in)
+                
+                    status = 'unchanged' if meta.get('sha1') == sha1.hexdigest() else 'downloaded'
+                    meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified'),
+                            'sha1': sha1.hexdigest(), 'size': os.path.getsize(gtfs_in)}
+        except requests.exceptions.RequestException as e:
+            # Connection errors after retries, timeouts and broken off transfers only leave this feed out.
+            logging.warning(f"Could not download {feed_id}: {e}")
+            if os.path.exists(gtfs_in + '.part'):
+                os.remove(gtfs_in + '.part')
+            return 'failed'
+        
+        meta['checked_at'] = now.isoformat()
+        json.dump(meta, open(meta_path, 'w'), indent=1)
+        return status
+        
+    def _extract_feeds(self, jobs):
+        """Runs extract_feed() for every job, in separate processes if extract_workers > 1.
+
+        Every feed gets its own process, which is killed when it takes longer than
+        extract_timeout. A feed which times out or fails is left out, without 
+        affecting the others.
+
+        Args:
+            jobs (list): Argument tuples for extract_feed(), starting with the feed_id.
+
+        Returns:
+            dict: Path of the extract per feed_id, None for feeds which are left out.
+        """
+        if self.extract_workers <= 1:
+            return {job[0]: extract_feed(*job) for job in jobs}
+        
+        # Forked rather than spawned, so scripts like 1-collect.py don't need a __main__ guard.
+        context = multiprocessing.get_context('fork')
+        results_queue = context.Queue()
+        pending, running, results = list(jobs), {}, {}
+        
+        def collect():
+            """Moves reported results from the queue, waiting at most a second for the next."""
+            try:
+                while True:
+                    feed_id, gtfs_out = results_queue.get(timeout=1)
+                    results[feed_id] = gtfs_out
+            except queue.Empty:
+                pass
+        
+        while pending or running:
+            
+            # Start feeds while there are free workers.
+            while pending and len(running) < self.extract_workers:
+                job = pending.pop(0)
+                process = context.Process(target=_run_extract_feed, args=(results_queue, logging.getLogger().level, job))
+                process.start()
+                running[job[0]] = (process, time.monotonic())
+            
+            # Collect results, and deal with processes which died or ran out of time.
+            collect()
+            
+            for feed_id, (process, started) in list(running.items()):
+                if feed_id not in results and not process.is_alive():
+                    collect() # It may have reported just before exiting.
+                if feed_id in results:
+                    process.join()
+                elif not process.is_alive():
+                    logging.warning(f"Not adding {feed_id}, extraction process died (exit code {process.exitcode}).")
+                    results[feed_id] = None
+                elif time.monotonic() - started > self.extract_timeout:
+                    logging.warning(f"Not adding {feed_id}, extraction took longer than {self.extract_timeout}s.")
+                    process.kill()
+                    process.join()
+                    results[feed_id] = None
+                else:
+                    continue
+                running.pop(feed_id)
+        
+        return results
         
     def download_feeds(self, feed_ids, target_dir, city_id, datefilter_list, force_dl=False, force_extr=False):
         """Downloads feeds from TransitLand from feed_ids to target_id, cutting 
@@ -90,105 +471,32 @@ class GtfsDownloader:
         # Create in- and output directories.
         os.makedirs(os.path.join(target_dir, 'src'), exist_ok=True)
         os.makedirs(os.path.join(target_dir, 'out'), exist_ok=True)
+        os.makedirs(os.path.join(target_dir, 'index'), exist_ok=True)
+        
+        # Download relevant source feeds, several at a time.
+        download = lambda feed_id: self._download_feed(os.path.join(target_dir, 'src', f'{feed_id}.gtfs.zip'), 
+                                                        feed_id, force=force_dl)
+        statuses = dict(imap_bounded(download, feed_ids, workers=self.workers))
+        logging.info(f"Source feeds: {pd.Series(statuses, dtype=object).value_counts().to_dict()}")
         
-        # Download relevant source feeds.
+        # Trim GTFS size to bounding box, in parallel processes if set.
+        jobs = []
         for feed_id in feed_ids:
             
-            # Construct source GTFS path and check for existence.
-            gtfs_in = os.path.join(target_dir, 'src', f'{feed_id}.gtfs.zip')
-            if os.path.exists(gtfs_in) and not force_dl:
-                
-                # Check for recency (less than one week old)
-                if datetime.datetime.fromtimestamp(os.path.getctime(gtfs_in)) > (datetime.datetime.now() - datetime.timedelta(weeks=1)):
-                    logging.debug(f"Skipping already recently downloaded {feed_id}")
-                    continue
-                else:
-                    logging.debug(f"Refreshing source feed {gtfs_in}")
-                    
-            # If does not exist, download to gtfs_in.
-            logging.info(f"Downloading {gtfs_in} (force_dl={str(force_dl)})")
-            feed = f"https://transit.land/api/v2/rest/feeds/{feed_id}/download_latest_feed_version"
-            params = {"apikey": self.tl_key}
-            response = requests.get(feed, params=params)
-            with open(gtfs_in, 'wb') as f:
-                f.write(response.content)
-            del feed
-            del response
-        
-        # Trim GTFS size to bounding box
-        feeds = []
-        for feed_id in feed_ids:
-
             # Declare the directory path for the GTFS zip file
             gtfs_in = os.path.join(target_dir, 'src', f'{feed_id}.gtfs.zip')
             gtfs_out = os.path.join(target_dir, 'out', f'{city_id}-{datefilter_str[0]}-{datefilter_str[-1]}-{feed_id}.gtfs.zip')
             
-            # Check if it already exists, if so, read in (if needed) and skip.
-            try:
-                if os.path.exists(gtfs_out) and not force_extr:
-                    logging.debug(f"Already extracted: {feed_id}")
-                    newfeed = gk.read_feed(gtfs_out, dist_units='km')
-                else:
-                    # Read the feed with gtfs-kit, restrict to bounding box, and write out.
-                    logging.info(f"Creating GTFS extract at {gtfs_out}. (force_extr={str(force_extr)})")
-                    newfeed = gk.read_feed(gtfs_in, dist_units='km')
-                    
-                    logging.debug(f'===== Feed {feed_id} before limiting:')
-                    logging.debug(newfeed.routes.head(10))
-                    logging.debug(f'Routes: {newfeed.routes.shape}')
-                    logging.debug(f'Stops: {newfeed.stops.shape}')
-                    logging.debug(f'Trips: {newfeed.trips.shape}')
-                    
-                    # Limit geographic and date range.
-                    logging.debug("Restricting area.")
-                    newfeed = newfeed.restrict_to_area(self.bbox_gdf)
-                    
-                    logging.debug("Restricting dates.")
-                    newfeed = newfeed.restrict_to_dates(list(set(datefilter_str)))
-                    
-                    logging.debug("Recreating shapes.")
-                    newfeed = newfeed.create_shapes(all_trips=True) # Recreate shapes for accuracy.
-                    
-                    logging.debug("Fixing zombies.")
-                    # newfeed = newfeed.drop_zombies()
-                    
-                    logging.debug("Fixing stops.")
-                    # Drop stops with NaN as stop_id if there is more than one.
-                    # if newfeed.stops.stop_id.isna().sum() == 1:
-                    #     print("renaming the bastard")
-                    #     newfeed.stop_times.stop_id = newfeed.stop_times.stop_id.fillna("tmp_stop_id")
-                    #     newfeed.stops.stop_id = newfeed.stops.stop_id.fillna("tmp_stop_id")
-                    if newfeed.stops.stop_id.isna().sum() >= 1:
-                        logging.warning("Dropping the bastards")
-                        newfeed.stop_times = newfeed.stop_times[newfeed.stop_times.stop_id.notna()]
-                        newfeed.stops = newfeed.stops[newfeed.stops.stop_id.notna()]
-                    
-                    logging.debug("Writing out.")
-                    newfeed.write(gtfs_out)
-                
-            # Sometimes there's a read error. 
-            except pd.errors.ParserError:
-                logging.warning(f'Not adding {feed_id}, bad feed, read exception. Continuing without...')
-                logging.warning(traceback.format_exc())
-                continue;
-            
-            # Check for validity. 
-            if not (isinstance(newfeed.routes, pd.DataFrame) 
-                    and isinstance(newfeed.stops, pd.DataFrame)
-                    and isinstance(newfeed.trips, pd.DataFrame)):
-                logging.info(f"Feed {feed_id} was empty. This can be because nothing was within bbox.")
+            # Feeds which couldn't be downloaded are left out.
+            if not os.path.exists(gtfs_in):
+                logging.warning(f"Not adding {feed_id}, no source feed was downloaded.")
                 continue
-            
-            logging.debug(f'===== Feed {feed_id} after restrictions.')
-            logging.debug(f'Routes: {newfeed.routes.shape}')
-            logging.debug(f'Stops: {newfeed.stops.shape}')
-            logging.debug(f'Trips: {newfeed.trips.shape}')
-            logging.debug(newfeed.routes.head(10))
-            
-            # If good, add to feed list.
-            if (newfeed.stops.shape[0] > 0 and newfeed.trips.shape[0] > 0):
-                logging.info(f"Appending feed {feed_id} correctly.")
-                feeds.append(gtfs_out)
+            jobs.append((feed_id, gtfs_in, gtfs_out, os.path.join(target_dir, 'index'), 
+                         self.bbox_gdf, datefilter_str, force_extr))
+        results = self._extract_feeds(jobs)
+        
+        # Keep the order of feed_ids, whichever feed finished first.
+        feeds = [results[feed_id] for feed_id in feed_ids if results.get(feed_id) is not None]
         
         if len(feed_ids) - len(feeds) > 1:
             logging.warning(f"Out of total {len(feed_ids)}, only {len(feeds)} were found fit.")
@@ -208,7 +516,8 @@ if __name__ == "__main__":
     
     gtfs_client = GtfsDownloader(tl_key=os.environ['TRANSITLAND_KEY'])
     gtfs_client.set_search(centroid, bbox, radius)
-    feed_ids = gtfs_client.search_feeds()
+    feed_ids = gtfs_client.search_feeds(cache_path='../1-data/2-gtfs/search/12345.json')
     logging.info(feed_ids)
     dates = [datetime.datetime(2023, 8, 22), datetime.datetime(2023, 8, 23)]
-    gtfs_client.download_feeds(feed_ids, '../1-data/2-gtfs/', 12345, dates, force_dl=False, force_extr=False)
\ No newline at end of file
+    feeds = gtfs_client.download_feeds(feed_ids, '../1-data/2-gtfs/', 12345, dates, force_dl=False, force_extr=False)
+    merge_feeds(feeds, '../1-data/2-gtfs/out/12345-merged.gtfs.zip')
\ No newline at end of file
@@ -24,6 +24,8 @@ import traceback
 # Import custom libraries
 sys.path.append(os.path.realpath('../'))
 from util.extract_urbancenter import ExtractCenters
+from util.session import make_session
+from util.pool import imap_bounded
 
 class Graphhopper:
     droot = ''
@@ -36,9 +38,12 @@ class Graphhopper:
     fetched_google = 0
     lockfile_path = ''
     
-    def __init__(self, droot, city):
+    def __init__(self, droot, city, url="http://localhost:8989", workers=4):
         self.droot = droot
         self.city = str(city)
+        self.url = url
+        self.workers = workers
+        self.session = make_session(pool_size=workers)
         self.config_src_path   = os.path.join(self.droot, '2-gh', 'config-duttv2.src.yml')
         self.config_out_path   = os.path.join(self.droot, '2-gh', 'config-duttv2.yml')
         self.factor_cache_path = os.path.join(self.droot, '2-gh', 'factor-cache.json')
@@ -239,7 +244,7 @@ class Graphhopper:
                 ],
             }
         }
-        response = requests.post('http://localhost:8989/route', headers=headers, json=json_data)
+        response = self.session.post(f'{self.url}/route', headers=headers, json=json_data)
         return response.json()
     
     def route_google(self, point1, point2, timestamp):        
@@ -353,7 +358,7 @@ class Graphhopper:
         logging.info(f"Formatted datetime to localised {peak_dt} and {off_dt}.")
     
         # Move points to actual roads.
-        points = points.apply(lambda x: self.nearest(x))
+        points = self.nearest_many(points)
         bounds = [(0.5, max)] * 5
         timestamp = ''
         def error_function(factors):
@@ -382,25 +387,26 @@ class Graphhopper:
 
     def nearest(self, point):
         
-        for attempt in range(5):
-            try:
-                url = "http://localhost:8989/nearest"
-                response = requests.request("GET", url, params={"point": f"{point.y},{point.x}"}).json()
-                if not 'coordinates' in response:
-                    logging.warning(f"GH Nearest no resolve: {response}")
-                    return point
-                
-                coords = response['coordinates']
-                return Point(coords[0], coords[1])
-            
-            except ConnectionError as e:
-                if attempt < 5:
-                    logging.error("Couldn't connect to GraphHopper, waiting 1 second and trying again.")
-                    time.sleep(1)
-                    pass
-                else:
-                    logging.error("Couldn't connect to GraphHopper, raising error.")
-                    raise e
+        # Connection failures and 5xx responses are retried with backoff by the session.
+        try:
+            response = self.session.get(f"{self.url}/nearest", params={"point": f"{point.y},{point.x}"}).json()
+        except requests.exceptions.ConnectionError as e:
+            logging.error("Couldn't connect to GraphHopper after retrying, raising error.")
+            raise e
+        
+        if not 'coordinates' in response:
+            logging.warning(f"GH Nearest no resolve: {response}")
+            return point
+        
+        coords = response['coordinates']
+        return Point(coords[0], coords[1])
+    
+    def nearest_many(self, points):
+        """Snaps a GeoSeries of points to the nearest road, with several requests in flight."""
+        assert isinstance(points, gpd.GeoSeries)
+        
+        results = dict(imap_bounded(lambda idx: self.nearest(points.loc[idx]), points.index, workers=self.workers))
+        return gpd.GeoSeries([results[idx] for idx in points.index], index=points.index, crs=points.crs)
         
 
 def test():
@@ -424,8 +430,8 @@ def test():
     graphhopper.build()
     
     # Try to calibrate example build.
-    sample = gdf.centroid.to_crs('EPSG:4326').sample(15, random_state=10)
-    sample = sample.apply(lambda x: graphhopper.nearest(x))
+    sample = ExtractCenters.centroids(gdf).sample(15, random_state=10)
+    sample = graphhopper.nearest_many(sample)
     peak_dt = datetime.datetime(2023, 9, 12, 8, 30, 0)
     off_dt  = datetime.datetime(2023, 9, 12, 13, 30, 0)
     # graphhopper.calibrate(sample, peak_dt=peak_dt, off_dt=off_dt, force=True)
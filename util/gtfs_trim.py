@@ -0,0 +1,263 @@
+import io
+import os
+import shutil
+import datetime
+import zipfile
+import logging
+import numpy as np
+import pandas as pd
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Tables which are small enough to be read in full, next to stop_times which is streamed.
+SMALL_TABLES = ['agency', 'stops', 'routes', 'trips', 'calendar', 'calendar_dates', 'frequencies', 'transfers', 'feed_info']
+
+# Uncompressed bytes of stop_times per bucket when sorting the index, and rows per Parquet row group.
+BUCKET_BYTES = 256 * 1024 * 1024
+ROW_GROUP_SIZE = 100000
+
+def _members(zf):
+    """Maps GTFS file names to zip members, also for feeds which are zipped with a folder."""
+    return {os.path.basename(name): name for name in zf.namelist() if name.endswith('.txt')}
+
+def _strip(table):
+    """Strips whitespace around column names, which some feeds pad their headers with."""
+    table.columns = table.columns.str.strip()
+    return table
+
+def _read(zf, members, name, usecols=None, chunksize=None, **kwargs):
+    """Reads a GTFS table as strings, so values are written out exactly as they came in.
+
+    Column names are stripped, also per chunk when reading in chunks, and usecols
+    refers to the stripped names.
+    """
+    if name not in members:
+        return None
+    if usecols is not None:
+        kwargs['usecols'] = lambda column: column.strip() in usecols
+    table = pd.read_csv(zf.open(members[name]), dtype=str, keep_default_na=False, encoding='utf-8-sig',
+                        chunksize=chunksize, **kwargs)
+    if chunksize is None:
+        return _strip(table)
+    return (_strip(chunk) for chunk in table)
+
+def _write(zf, name, table):
+    """Writes a table to the output zip, skipping tables which weren't in the source."""
+    if table is not None:
+        with zf.open(name, 'w') as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+            table.to_csv(f, index=False)
+
+def active_services(calendar, calendar_dates, dates):
+    """Service ids running on any of the dates, following calendar and calendar_dates exceptions.
+
+    Args:
+        calendar (DataFrame): calendar.txt as strings, or None.
+        calendar_dates (DataFrame): calendar_dates.txt as strings, or None.
+        dates (list): Dates as YYYYMMDD strings.
+
+    Returns:
+        set: Active service ids.
+    """
+    services = set()
+    for date in dates:
+        weekday = WEEKDAYS[datetime.datetime.strptime(date, '%Y%m%d').weekday()]
+        active = set()
+        if calendar is not None and len(calendar) > 0:
+            running = (calendar.start_date <= date) & (calendar.end_date >= date) & (calendar[weekday] == '1')
+            active = set(calendar.service_id[running])
+        if calendar_dates is not None and len(calendar_dates) > 0:
+            on_date = calendar_dates[calendar_dates.date == date]
+            active |= set(on_date.service_id[on_date.exception_type == '1'])
+            active -= set(on_date.service_id[on_date.exception_type == '2'])
+        services |= active
+    return services
+
+def _stops_in_area(stops, area):
+    """Ids of the stops within an area."""
+    lon = pd.to_numeric(stops.stop_lon, errors='coerce').values
+    lat = pd.to_numeric(stops.stop_lat, errors='coerce').values
+    return set(stops.stop_id[shapely.intersects_xy(area.to_crs('EPSG:4326').unary_union, lon, lat)])
+
+def _restrict(tables, keep, used_stops):
+    """Cuts the small tables down to what the kept trips and their stops refer to.
+
+    Args:
+        tables (dict): Small tables by name, None for those missing in the feed.
+        keep (set): Kept trip ids.
+        used_stops (set): Stop ids used by the stop times of the kept trips.
+
+    Returns:
+        dict: Restricted tables by name.
+    """
+    tables = dict(tables)
+    stops, trips = tables['stops'], tables['trips']
+    trips = tables['trips'] = trips[trips.trip_id.isin(keep)]
+
+    # Stops with their parent stations.
+    if 'parent_station' in stops.columns:
+        parents = set(stops.parent_station[stops.stop_id.isin(used_stops)]) - {''}
+        used_stops = used_stops | parents | (set(stops.parent_station[stops.stop_id.isin(parents)]) - {''})
+    tables['stops'] = stops[stops.stop_id.isin(used_stops)]
+
+    # Tables referring to the kept trips.
+    routes = tables['routes'] = tables['routes'][tables['routes'].route_id.isin(trips.route_id)]
+    if tables['agency'] is not None and 'agency_id' in routes.columns and (routes.agency_id != '').all():
+        tables['agency'] = tables['agency'][tables['agency'].agency_id.isin(routes.agency_id)]
+    for name in ['calendar', 'calendar_dates']:
+        if tables[name] is not None:
+            tables[name] = tables[name][tables[name].service_id.isin(trips.service_id)]
+    if tables['frequencies'] is not None:
+        tables['frequencies'] = tables['frequencies'][tables['frequencies'].trip_id.isin(keep)]
+    transfers = tables['transfers']
+    if transfers is not None and 'from_stop_id' in transfers.columns:
+        tables['transfers'] = transfers[transfers.from_stop_id.isin(used_stops) & transfers.to_stop_id.isin(used_stops)]
+    return tables
+
+class _SortedWriter:
+    """Writes a Parquet file sorted by a key column, holding only one bucket of rows in memory.
+
+    Rows are first spread over bucket files of contiguous key ranges, split on the
+    sorted known values of the key. On close, the buckets are sorted one by one and
+    appended in order. Every row group then covers a narrow range of keys, so reads
+    filtered on the key skip the row groups which can't match.
+    """
+
+    def __init__(self, path, columns, key, values, n_buckets=1, unique=False):
+        self.path = path
+        self.key = key
+        self.unique = unique
+        self.schema = pa.schema([(column, pa.string()) for column in columns])
+        values = sorted(values)
+        self.bounds = np.array(values[::max(1, -(-len(values) // n_buckets))][1:], dtype=object)
+        self.writers = {}
+
+    def _bucket_path(self, i):
+        """Path of the unsorted rows of bucket i."""
+        return f'{self.path}.{i}'
+
+    def write(self, chunk):
+        """Appends the rows of a DataFrame chunk to the buckets of their keys."""
+        buckets = np.searchsorted(self.bounds, chunk[self.key].values, side='right')
+        for i in np.unique(buckets):
+            if i not in self.writers:
+                self.writers[i] = pq.ParquetWriter(self._bucket_path(i), self.schema)
+            self.writers[i].write_table(pa.Table.from_pandas(chunk[buckets == i], schema=self.schema, preserve_index=False))
+
+    def close(self):
+        """Sorts the buckets in order into the output file, dropping duplicate rows if unique."""
+        for writer in self.writers.values():
+            writer.close()
+
+        with pq.ParquetWriter(self.path, self.schema) as out:
+            for i in sorted(self.writers):
+                table = pq.read_table(self._bucket_path(i))
+                if self.unique:
+                    table = pa.Table.from_pandas(table.to_pandas().drop_duplicates(), schema=self.schema, preserve_index=False)
+                out.write_table(table.sort_by(self.key), row_group_size=ROW_GROUP_SIZE)
+                os.remove(self._bucket_path(i))
+
+def index_feed(gtfs_in, index_path, dates, chunksize=1000000):
+    """Parses a feed once for a set of dates into a Parquet index, which cities are cut from with cut_feed().
+
+    Only trips active on the dates are kept. Stop times are stored in full, sorted by
+    trip_id, next to a table of (stop_id, trip_id) pairs sorted by stop_id, so finding
+    the trips stopping in an area and their stop times only reads matching row groups.
+    The index is written to a temporary directory and moved in place when complete,
+    so an existing index is always whole.
+
+    Args:
+        gtfs_in (path): Source GTFS zip.
+        index_path (path): Directory to write the index to, unique per feed version and dates.
+        dates (list): Dates as YYYYMMDD strings.
+        chunksize (int): Rows of stop_times per chunk. Defaults to 1000000.
+
+    Returns:
+        path: index_path.
+    """
+    if os.path.exists(index_path):
+        logging.debug(f"Feed index already exists: {index_path}")
+        return index_path
+
+    logging.info(f"Indexing {os.path.basename(gtfs_in)} for {dates} at {index_path}")
+    tmp_path = os.path.join(os.path.dirname(index_path), '_' + os.path.basename(index_path))
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    with zipfile.ZipFile(gtfs_in) as zf:
+        members = _members(zf)
+        tables = {name: _read(zf, members, f'{name}.txt') for name in SMALL_TABLES}
+        services = active_services(tables['calendar'], tables['calendar_dates'], dates)
+        tables['trips'] = tables['trips'][tables['trips'].service_id.isin(services)]
+        active = set(tables['trips'].trip_id)
+
+        # Stream the stop times of active trips into Parquet, with the stop-trip pairs on the side.
+        # Both are sorted, by trip_id and stop_id respectively, in buckets of bounded size.
+        n_buckets = max(1, -(-zf.getinfo(members['stop_times.txt']).file_size // BUCKET_BYTES))
+        columns = _read(zf, members, 'stop_times.txt', nrows=0).columns
+        stop_times = _SortedWriter(os.path.join(tmp_path, 'stop_times.parquet'), columns, 'trip_id', active, n_buckets)
+        stop_trips = _SortedWriter(os.path.join(tmp_path, 'stop_trips.parquet'), ['stop_id', 'trip_id'], 'stop_id',
+                                   tables['stops'].stop_id, n_buckets, unique=True)
+        rows = 0
+        for chunk in _read(zf, members, 'stop_times.txt', chunksize=chunksize):
+            chunk = chunk[chunk.trip_id.isin(active)]
+            stop_times.write(chunk)
+            stop_trips.write(chunk[['stop_id', 'trip_id']].drop_duplicates())
+            rows += len(chunk)
+        stop_times.close()
+        stop_trips.close()
+
+    for name, table in tables.items():
+        if table is not None:
+            table.to_parquet(os.path.join(tmp_path, f'{name}.parquet'), index=False)
+
+    os.replace(tmp_path, index_path)
+    logging.info(f"Indexed {len(active)} active trips with {rows} stop times.")
+    return index_path
+
+def cut_feed(index_path, gtfs_out, area):
+    """Cuts a GTFS zip for an area from a feed index.
+
+    Keeps the active trips stopping within the area with all their stop times, the
+    stops they use with their parent stations, and the routes, agencies, services,
+    frequencies and transfers they refer to. Shapes are left out, they're recreated
+    from the cut feed.
+
+    Args:
+        index_path (path): Directory written by index_feed().
+        gtfs_out (path): Trimmed GTFS zip to write.
+        area (GeoDataFrame): Area in EPSG:4326, trips stopping within it are kept.
+
+    Returns:
+        int: Number of trips kept. Nothing is written when no trips stop in the area.
+    """
+    tables = {name: pd.read_parquet(os.path.join(index_path, f'{name}.parquet'))
+              if os.path.exists(os.path.join(index_path, f'{name}.parquet')) else None
+              for name in SMALL_TABLES}
+
+    # Trips stopping in the area. Both tables are sorted on the filtered column, so only matching row groups are read.
+    area_stops = sorted(_stops_in_area(tables['stops'], area))
+    keep = set()
+    if area_stops:
+        stop_trips = pq.read_table(os.path.join(index_path, 'stop_trips.parquet'), columns=['trip_id'],
+                                   filters=[('stop_id', 'in', area_stops)])
+        keep = set(stop_trips.column('trip_id').to_pylist())
+    if not keep:
+        logging.info(f"No trips stopping in the area in {os.path.basename(index_path)}.")
+        return 0
+
+    # Their stop times.
+    stop_times = pq.read_table(os.path.join(index_path, 'stop_times.parquet'),
+                               filters=[('trip_id', 'in', sorted(keep))]).to_pandas()
+
+    with zipfile.ZipFile(gtfs_out, 'w', compression=zipfile.ZIP_DEFLATED) as out:
+        _write(out, 'stop_times.txt', stop_times)
+        tables = _restrict(tables, keep, set(stop_times.stop_id))
+        for name, table in tables.items():
+            _write(out, f'{name}.txt', table)
+
+    logging.info(f"Cut {len(keep)} trips, {len(tables['stops'])} stops and {len(tables['routes'])} routes "
+                 f"from {os.path.basename(index_path)}.")
+    return len(keep)
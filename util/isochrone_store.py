@@ -0,0 +1,211 @@
+import os
+import json
+import hashlib
+import logging
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columns holding geometry in the preprocessed isochrones, stored as WKB. Cities converted from
+# pickles written before reach_ids keep their dissolved reach in reach_geo.
+GEOMETRY_COLUMNS = ['isochrone', 'isochrone_buf', 'startpt', 'raster', 'reach_geo']
+
+# Rows per row group in the combined file, below pyarrow's maximum so every write is exactly one row group.
+ROW_GROUP_ROWS = 512 * 1024
+
+def city_path(root, country_id, city_id):
+    """Path of a city's file in the GeoParquet dataset, partitioned as country_id=../city_id=.."""
+    return os.path.join(root, f'country_id={country_id}', f'city_id={city_id}', 'part-0.parquet')
+
+def write_city(isochrones, root, country_id, city_id):
+    """Writes a city's preprocessed isochrones to the partitioned GeoParquet dataset.
+
+    The partition columns are dropped from the file itself, they are restored from
+    the directory names when reading. Timezone-aware columns like dep_dt are stored
+    in UTC, so cities in different timezones combine. Written to a temporary file 
+    first, so an interrupted run never leaves a half-written city behind.
+
+    Args:
+        isochrones (GeoDataFrame): Preprocessed isochrones of one city.
+        root (path): Root directory of the dataset.
+        country_id (str): Country of the city, e.g. NLD.
+        city_id (int): City id.
+
+    Returns:
+        path: Path of the written file.
+    """
+    assert isinstance(isochrones, gpd.GeoDataFrame)
+
+    path = city_path(root, country_id, city_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Readers skip files starting with an underscore, so the temporary file is never picked up.
+    tmp_path = os.path.join(os.path.dirname(path), '_' + os.path.basename(path))
+    isochrones = isochrones.drop(columns=['country_id', 'city_id'], errors='ignore')
+
+    # Departure times are local to each city, store them in UTC so all cities share one type.
+    for column in isochrones.columns:
+        if isinstance(isochrones[column].dtype, pd.DatetimeTZDtype):
+            isochrones[column] = isochrones[column].dt.tz_convert('UTC')
+    isochrones.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+    logging.debug(f"Wrote {len(isochrones)} isochrones to {path}")
+    return path
+
+def read_isochrones(root, columns=None, city_id=None, country_id=None, mode=None, tt_mnts=None):
+    """Reads (part of) the GeoParquet isochrone dataset, without loading what isn't asked for.
+
+    Filters on cities and countries skip whole partitions, other filters and the
+    column selection are pushed down to the Parquet reader.
+
+    Args:
+        root (path): Root directory of the dataset, or a single Parquet file.
+        columns (list, optional): Columns to read. Defaults to all.
+        city_id (int or list, optional): City id(s) to read.
+        country_id (str or list, optional): Country id(s) to read, e.g. NLD.
+        mode (str or list, optional): Travel mode(s), e.g. transit_peak.
+        tt_mnts (int or list, optional): Travel time budget(s) in minutes.
+
+    Returns:
+        GeoDataFrame: Matching isochrones, or a DataFrame if no geometry columns were selected.
+    """
+    filters = []
+    for column, value in [('city_id', city_id), ('country_id', country_id), ('trmode', mode), ('tt_mnts', tt_mnts)]:
+        if value is not None:
+            filters.append((column, 'in', list(value) if isinstance(value, (list, tuple, set)) else [value]))
+    filters = filters if len(filters) > 0 else None
+
+    if columns is not None and not any(c in GEOMETRY_COLUMNS for c in columns):
+        return pd.read_parquet(root, columns=columns, filters=filters)
+    return gpd.read_parquet(root, columns=columns, filters=filters)
+
+def _file_state(path, previous=None):
+    """Identifies a file's version by size and mtime, falling back to its sha1 if only those changed."""
+    stat = os.stat(path)
+    state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and previous.get('size') == state['size'] and previous.get('mtime_ns') == state['mtime_ns']:
+        state['sha1'] = previous.get('sha1')
+        return state
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    state['sha1'] = sha1.hexdigest()
+    return state
+
+def _utc(schema):
+    """Schema with timezone-aware timestamps in UTC, for city files written in their local timezone."""
+    fields = [f.with_type(pa.timestamp(f.type.unit, tz='UTC')) if pa.types.is_timestamp(f.type) and f.type.tz else f
+              for f in schema]
+    return pa.schema(fields, metadata=schema.metadata)
+
+def _geo_metadata(schemas):
+    """GeoParquet metadata covering all schemas, with the geometry types of every column combined.
+
+    Bounding boxes are left out as they're per city. An empty list of geometry types
+    means any type, so a column only keeps a list if every city that has it does.
+    """
+    geo = None
+    for schema in schemas:
+        if schema.metadata is None or b'geo' not in schema.metadata:
+            continue
+        city_geo = json.loads(schema.metadata[b'geo'])
+        if geo is None:
+            geo = city_geo | {'columns': {}}
+        for name, column in city_geo['columns'].items():
+            column.pop('bbox', None)
+            types = column.get('geometry_types', [])
+            if name not in geo['columns']:
+                geo['columns'][name] = column
+            elif geo['columns'][name].get('geometry_types') and types:
+                geo['columns'][name]['geometry_types'] = sorted(set(geo['columns'][name]['geometry_types']) | set(types))
+            else:
+                geo['columns'][name]['geometry_types'] = []
+    return geo
+
+def _conform(table, schema):
+    """Orders a table's columns like schema, adding missing ones as nulls."""
+    columns = [table.column(f.name).cast(f.type) if f.name in table.column_names else pa.nulls(len(table), f.type)
+               for f in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def combine(sources, out_path, manifest_path=None):
+    """Streams per-city Parquet files into one combined file, in consecutive row groups per city.
+
+    Only one city is held in memory at a time. A manifest records the state of every
+    source; if nothing changed since the last export the output is left as is, and 
+    cities whose source is unchanged are copied from the previous output as raw 
+    row groups instead of being read again.
+
+    Args:
+        sources (list): Tuples of (country_id, city_id, path) to combine, in order.
+        out_path (path): Combined GeoParquet file to write.
+        manifest_path (path, optional): Defaults to out_path with .manifest.json.
+
+    Returns:
+        int: Number of cities which were (re)read from their source.
+    """
+    if len(sources) == 0:
+        logging.warning("No cities to combine.")
+        return 0
+    
+    manifest_path = manifest_path or os.path.splitext(out_path)[0] + '.manifest.json'
+    previous = {}
+    if os.path.exists(manifest_path) and os.path.exists(out_path):
+        previous = json.load(open(manifest_path, 'r'))['cities']
+
+    # Check which cities changed. Manifests without row group counts predate splitting cities over row groups.
+    states = {str(city_id): _file_state(path, previous.get(str(city_id))) for _, city_id, path in sources}
+    changed = [str(city_id) for _, city_id, _ in sources
+               if str(city_id) not in previous or previous[str(city_id)]['sha1'] != states[str(city_id)]['sha1']
+               or 'row_groups' not in previous[str(city_id)]]
+    if len(changed) == 0 and list(states) == list(previous):
+        logging.info(f"No changes since last export, keeping {out_path}")
+        return 0
+    logging.info(f"Combining {len(sources)} cities, of which {len(changed)} changed since the last export.")
+
+    # Unify schemas up front, from the file footers only.
+    schemas = [_utc(pq.read_schema(path)) for _, _, path in sources]
+    partitions = pa.schema([('country_id', pa.string()), ('city_id', pa.int64())])
+    schema = pa.unify_schemas([s.remove_metadata() for s in schemas] + [partitions])
+    geo = _geo_metadata(schemas)
+    if geo is not None:
+        schema = schema.with_metadata({b'geo': json.dumps(geo).encode()})
+
+    old = pq.ParquetFile(out_path) if len(previous) > 0 else None
+    tmp_path = os.path.join(os.path.dirname(out_path), '_' + os.path.basename(out_path))
+    manifest = {}
+    row_group = 0
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for country_id, city_id, path in sources:
+            key = str(city_id)
+            if key in changed:
+                logging.info(f"Reading {country_id} {city_id} from {path}")
+                table = pq.read_table(path)
+                table = table.append_column('country_id', pa.array([str(country_id)] * len(table), pa.string()))
+                table = table.append_column('city_id', pa.array([int(city_id)] * len(table), pa.int64()))
+            else:
+                first = previous[key]['row_group']
+                table = old.read_row_groups(range(first, first + previous[key]['row_groups']))
+            
+            # Large cities span several row groups, each write of at most ROW_GROUP_ROWS is exactly one.
+            table = _conform(table, schema)
+            offsets = range(0, len(table), ROW_GROUP_ROWS) if len(table) > 0 else [0]
+            for offset in offsets:
+                chunk = table.slice(offset, ROW_GROUP_ROWS)
+                writer.write_table(chunk, row_group_size=max(len(chunk), 1))
+            manifest[key] = states[key] | {'row_group': row_group, 'row_groups': len(offsets), 'rows': len(table)}
+            row_group += len(offsets)
+    
+    if old is not None:
+        old.close()
+    assert pq.ParquetFile(tmp_path).num_row_groups == row_group, "Row groups don't match the manifest."
+    os.replace(tmp_path, out_path)
+    with open(manifest_path, 'w') as f:
+        json.dump({'cities': manifest}, f, indent=1)
+    
+    logging.info(f"Wrote {sum(m['rows'] for m in manifest.values())} isochrones to {out_path}")
+    return len(changed)
@@ -7,8 +7,13 @@ import pandas as pd
 import itertools
 import geopandas as gpd
 import sqlite3 as sl
-from shapely.geometry import Point, Polygon, MultiPolygon
-from shapely import wkt
+import zlib
+import hashlib
+import time
+import math
+import numpy as np
+import shapely
+from shapely.geometry import Point, Polygon, MultiPolygon, shape
 from datetime import datetime
 from timezonefinder import TimezoneFinder
 from tqdm import tqdm
@@ -19,17 +24,261 @@ from util.fetch_transitland_gtfs import GtfsDownloader
 from util.graphhopper import Graphhopper
 from util.extract_osm import extract_osm
 from util.extract_urbancenter import ExtractCenters
+from util.pool import imap_bounded
+from util.session import make_session
+
+# Version of the cache schema, stored in PRAGMA user_version. 
+#   1: geometry stored as (zlib-compressed) WKB.
+#   2: compact integer key (ukey) filled for every row.
+SCHEMA_VERSION = 2
+
+# Known travel modes and sources, their position is part of the compact uid key. Only append to these.
+MODES = ['driving_off', 'driving_peak', 'transit_off', 'transit_peak', 
+         'transit_bike_off', 'transit_bike_peak', 'walking', 'cycling']
+SOURCES = ['g', 'b', 'h'] # GraphHopper, Bing, Here
+
+# Translate standardised mode string to graphhopper profile.
+GH_MODES = {
+    "driving_off": 'car_cbr_off',
+    "driving_peak": 'car_cbr_peak',
+    "walking": 'foot',
+    "cycling": 'bike',
+    'transit_off': 'pt',
+    'transit_peak': 'pt',
+    'transit_bike_off': 'pt',
+    'transit_bike_peak': 'pt'
+}
+
+# Most buckets to request at once when combining time budgets into one isochrone request.
+MAX_BUCKETS = 6
+
+def encode_ukey(city_id, pid, trmode, tt_mnts, source):
+    """Packs (city_id, pid, mode, minutes, source) into one 63-bit integer, vectorized.
+    
+    Layout from high to low bits: city_id (21), pid (28), mode (4), tt_mnts (8), source (2).
+    """
+    city_id = np.asarray(city_id, dtype=np.int64)
+    pid     = np.asarray(pid, dtype=np.int64)
+    tt_mnts = np.asarray(tt_mnts, dtype=np.int64)
+    mode    = pd.Categorical(trmode, categories=MODES).codes.astype(np.int64)
+    source  = pd.Categorical(source, categories=SOURCES).codes.astype(np.int64)
+    
+    assert (city_id < 2**21).all() and (pid < 2**28).all() and (tt_mnts < 2**8).all()
+    assert (mode >= 0).all() and (source >= 0).all()
+    return (((((city_id << 28) | pid) << 4 | mode) << 8 | tt_mnts) << 2) | source
+
+def decode_ukey(ukey):
+    """Unpacks compact uid keys into a DataFrame with city_id, pid, trmode, tt_mnts and source."""
+    ukey = np.asarray(ukey, dtype=np.int64)
+    return pd.DataFrame({
+        'city_id': ukey >> 42,
+        'pid':     (ukey >> 14) & (2**28 - 1),
+        'trmode':  np.array(MODES)[(ukey >> 10) & 0xF],
+        'tt_mnts': (ukey >> 2) & 0xFF,
+        'source':  np.array(SOURCES)[ukey & 0x3],
+    })
+
+def build_batch(city_id, points, config):
+    """Builds the request batch as cross join of points x config x tt_mnts, with their uids.
+    
+    Rows are ordered by pid, then config, then minutes. Besides the readable uid, 
+    rows get a compact integer ukey (see encode_ukey) if city_id is numeric.
+    """
+    points = gpd.GeoSeries(points, crs='EPSG:4326').values.to_numpy()
+    configs = pd.DataFrame(
+        [(trmode, tt_mnts, dep_dt, source) 
+         for trmode, tt_mnts_list, dep_dt, source in config 
+         for tt_mnts in tt_mnts_list],
+        columns=['trmode', 'tt_mnts', 'dep_dt', 'source'])
+    
+    pid = np.repeat(np.arange(len(points)), len(configs))
+    batch = configs.iloc[np.tile(np.arange(len(configs)), len(points))].reset_index(drop=True)
+    batch.insert(0, 'pid', pid)
+    batch.insert(1, 'startpt', points[pid])
+    batch = gpd.GeoDataFrame(batch, geometry='startpt', crs='EPSG:4326')
+    batch['city_id'] = city_id
+    
+    # Type checking
+    assert batch.trmode.isin(MODES).all()
+    assert batch.source.isin(SOURCES).all()
+    
+    batch['uid'] = (f"{city_id}-" + batch.pid.astype(str) + "-" + batch.trmode + "-" 
+                    + batch.tt_mnts.astype(str) + "m-" + batch.source)
+    try:
+        batch['ukey'] = encode_ukey(int(city_id), batch.pid, batch.trmode, batch.tt_mnts, batch.source)
+    except (TypeError, ValueError):
+        batch['ukey'] = None
+    
+    return batch
+
+def encode_geometry(geometry, compress=False):
+    """Encodes a geometry as WKB for the cache, optionally zlib-compressed."""
+    blob = shapely.to_wkb(geometry)
+    return zlib.compress(blob) if compress else blob
+
+def decode_geometries(values):
+    """Decodes cached geometry values into an array of geometries.
+    
+    Accepts WKB, zlib-compressed WKB and legacy WKT (schema version 0), so a 
+    partially migrated cache can still be read. Empty values become None.
+    """
+    values = np.asarray(values, dtype=object)
+    result = np.full(len(values), None, dtype=object)
+    
+    # WKB always starts with a byte order flag (0 or 1), zlib streams with 0x78.
+    is_wkt = np.array([isinstance(x, str) for x in values], dtype=bool)
+    is_blob = np.array([isinstance(x, bytes) and len(x) > 0 for x in values], dtype=bool)
+    blobs = [zlib.decompress(x) if x[0] == 0x78 else x for x in values[is_blob]]
+    
+    result[is_blob] = shapely.from_wkb(np.array(blobs, dtype=object))
+    result[is_wkt] = shapely.from_wkt(values[is_wkt].astype(str))
+    return result
+
+def postprocess_isochrones(geometries, origins, buffer_mask, utm_crs=None):
+    """Cleans a batch of raw isochrones of one city in a single projection to UTM and back.
+    
+    GraphHopper polygons (buffer_mask) are buffered by 10m to close slivers, and 
+    polygons larger than 0.0001 degree^2 are simplified by 100m to remove detail.
+    
+    Args:
+        geometries (array): Raw polygons in EPSG:4326.
+        origins (array):    Start points in EPSG:4326, used to estimate the UTM zone.
+        buffer_mask (array): Booleans, which geometries to buffer.
+        utm_crs (CRS):      Projection to use, estimated from the origins if not given.
+    
+    Returns:
+        tuple: (cleaned geometries in EPSG:4326, area of the raw geometries in m2, utm_crs)
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    if utm_crs is None:
+        utm_crs = gpd.GeoSeries(origins, crs='EPSG:4326').estimate_utm_crs()
+    
+    large = shapely.area(geometries) > 0.0001
+    projected = gpd.GeoSeries(geometries, crs='EPSG:4326').to_crs(utm_crs).values.to_numpy()
+    area = shapely.area(projected)
+    
+    projected = np.where(buffer_mask, shapely.buffer(projected, 10), projected)
+    projected = np.where(large, shapely.simplify(projected, 100), projected)
+    cleaned = gpd.GeoSeries(projected, crs=utm_crs).to_crs('EPSG:4326').values.to_numpy()
+    
+    return cleaned, area, utm_crs
+
+class CacheWriter:
+    """Buffers isochrone results and writes them to the cache in batched transactions.
+    
+    Flushes when batch_size rows are buffered or flush_interval seconds have passed 
+    since the last commit. Use as a context manager so buffered rows are written 
+    when fetching stops, also on errors or a KeyboardInterrupt.
+    """
+    
+    def __init__(self, con, compress=False, batch_size=500, flush_interval=30):
+        self.con = con
+        self.compress = compress
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.geometries = []
+        self.utm_crs = {}
+        self.last_flush = time.monotonic()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+    
+    def add(self, item, polygon):
+        """Adds a raw result to the buffer, flushing if the batch is full or old enough."""
+        self.geometries.append(polygon)
+        self.rows.append((
+            item.uid, 
+            item.city_id,
+            item.pid,
+            item.startpt.y,
+            item.startpt.x,
+            item.tt_mnts, 
+            item.dep_dt.to_pydatetime(), 
+            item['trmode'],
+            item.source,
+            item.get('ukey')))
+        
+        if (len(self.rows) >= self.batch_size 
+            or time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+    
+    def _postprocess(self, rows, geometries):
+        """Cleans the buffered geometries per city, reusing each city's UTM zone, and encodes them."""
+        
+        geometries = np.asarray(geometries, dtype=object)
+        uids, city_ids, _, lats, lons, _, _, _, sources, _ = (np.array(col) for col in zip(*rows))
+        encoded = np.empty(len(rows), dtype=object)
+        
+        for city_id in np.unique(city_ids):
+            idx = np.flatnonzero(city_ids == city_id)
+            cleaned, area, self.utm_crs[city_id] = postprocess_isochrones(
+                geometries[idx], 
+                origins=gpd.points_from_xy(lons[idx], lats[idx]), 
+                buffer_mask=(sources[idx] == 'g'),
+                utm_crs=self.utm_crs.get(city_id))
+            encoded[idx] = [encode_geometry(g, compress=self.compress) for g in cleaned]
+            
+            if os.environ.get('ENVIRON', '') == 'dev':
+                for uid, a in zip(uids[idx][area < 100], area[area < 100]):
+                    logging.warning(f"Result for {uid} area is small: {a:.1f}m2.")
+        
+        return [row + (blob,) for row, blob in zip(rows, encoded)]
+    
+    def flush(self):
+        """Cleans and writes all buffered rows in a single transaction."""
+        self.last_flush = time.monotonic()
+        if len(self.rows) == 0:
+            return
+        
+        rows, self.rows = self.rows, []
+        geometries, self.geometries = self.geometries, []
+        rows = self._postprocess(rows, geometries)
+        sql = """
+            INSERT INTO isochrone (uid, city_id, pid, pt_lat, pt_lon, tt_mnts, dep_dt, mode, source, ukey, geometry)
+            values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        try:
+            with self.con:
+                self.con.executemany(sql, rows)
+        except sl.IntegrityError:
+            
+            # Write what is valid so nothing fetched is lost, and report the offending rows.
+            failed = []
+            for row in rows:
+                try:
+                    with self.con:
+                        self.con.execute(sql, row)
+                except sl.IntegrityError:
+                    failed.append(row[0])
+            raise sl.IntegrityError(f"Constraint failed, check above with UIDs {failed}")
+        
+        logging.debug(f"Wrote {len(rows)} isochrones to cache.")
 
 class Isochrones:
     """Facilitates interaction with Isochrones and caches results."""
     
-    def __init__(self, bing_key=None, graphhopper_url=None, db='cache.db'): 
+    def __init__(self, bing_key=None, graphhopper_url=None, db='cache.db', workers=4, timeout=(5, 300), compress=False,
+                 batch_size=500, flush_interval=30, compact_uid=False): 
         self.bing_key = bing_key
         self.graphhopper_url = graphhopper_url
         self.db = db
+        self.workers = workers
+        self.compact_uid = compact_uid
+        self.session = make_session(pool_size=workers, timeout=timeout)
         self.response = ""
         
+        # WAL lets readers (e.g. dry runs) continue while batches are committed.
         self.con = sl.connect(db)
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.execute("PRAGMA cache_size = -65536") # 64MB
+        self.con.execute("PRAGMA temp_store = MEMORY")
+        self.writer = CacheWriter(self.con, compress=compress, batch_size=batch_size, flush_interval=flush_interval)
         with self.con:
             self.con.execute("""
                 CREATE TABLE IF NOT EXISTS isochrone (
@@ -44,11 +293,70 @@ class Isochrones:
                     mode       TEXT NOT NULL,
                     source     TEXT NOT NULL,
                     
-                    geometry   BLOB NOT NULL
+                    geometry   BLOB NOT NULL,
+                    ukey       INTEGER
+                );
+            """)
+            
+            # Caches from before the compact key need the column added, util/migrate_cache.py fills it.
+            columns = [c[1] for c in self.con.execute("PRAGMA table_info(isochrone)")]
+            if 'ukey' not in columns:
+                self.con.execute("ALTER TABLE isochrone ADD COLUMN ukey INTEGER")
+            self.con.execute("CREATE UNIQUE INDEX IF NOT EXISTS isochrone_ukey ON isochrone (ukey)")
+            self.con.execute("""
+                CREATE TABLE IF NOT EXISTS snapped (
+                    city_id    TEXT NOT NULL,
+                    pid        INTEGER NOT NULL,
+                    osm        TEXT NOT NULL,
+                    pt_lat     REAL NOT NULL,
+                    pt_lon     REAL NOT NULL,
+                    
+                    PRIMARY KEY (city_id, pid, osm)
                 );
             """)
+            self.con.execute("""
+                CREATE INDEX IF NOT EXISTS isochrone_city_mode_tt 
+                ON isochrone (city_id, mode, tt_mnts);
+            """)
+        
+        # Older caches store WKT or miss keys, these can still be read but should be migrated.
+        self.version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        if self.version < SCHEMA_VERSION:
+            legacy = self.con.execute(
+                "SELECT 1 FROM isochrone WHERE typeof(geometry) = 'text' OR ukey IS NULL LIMIT 1").fetchone()
+            if legacy:
+                logging.warning(f"Cache {db} is at schema version {self.version}, run util/migrate_cache.py to upgrade it.")
+            else:
+                self.version = SCHEMA_VERSION
+                self.con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        
+        # Keys are only complete after migrating, otherwise rows would be missed and refetched.
+        if self.compact_uid and self.version < 2:
+            logging.warning("Compact uid keys are not filled for all rows yet, looking up by uid instead.")
+            self.compact_uid = False
         logging.debug(f'Started new Isochrones object...')
         
+    def _query_batch(self, city_id, batch, columns):
+        """Reads only the cached rows of a batch, joining the cache on a temporary table of its uids."""
+        
+        # Join on the integer key if enabled, which is smaller and faster to compare.
+        if self.compact_uid and batch.ukey.notna().all():
+            key, key_type, keys = 'ukey', 'INTEGER', batch.ukey.astype('int64').tolist()
+        else:
+            key, key_type, keys = 'uid', 'TEXT', batch.index.tolist()
+        
+        with self.con:
+            self.con.execute(f"CREATE TEMP TABLE IF NOT EXISTS batch_{key} ({key} {key_type} NOT NULL PRIMARY KEY)")
+            self.con.execute(f"DELETE FROM temp.batch_{key}")
+            self.con.executemany(f"INSERT OR IGNORE INTO temp.batch_{key} ({key}) VALUES (?)", ((k,) for k in keys))
+            
+            qry = f"""
+                SELECT {', '.join(f'i.{c}' for c in columns)} 
+                FROM temp.batch_{key} b JOIN isochrone i ON i.{key} = b.{key}
+                WHERE i.city_id = ?
+            """
+            return pd.read_sql_query(qry, self.con, params=(str(city_id),))
+    
     def _check_caches(self, city_id, batch):
         """Reads cache with polygons in a SQLite database."""
         
@@ -56,12 +364,10 @@ class Isochrones:
         batch = batch.set_index('uid')
         
         logging.debug("Finding isochrones from cache..")
-        with self.con:
-            qry = f"SELECT uid, geometry FROM isochrone WHERE city_id='{city_id}'"
-            cached = pd.read_sql_query(qry, self.con)
+        cached = self._query_batch(city_id, batch, ['uid', 'geometry'])
             
         logging.debug("Loading in geometry..")
-        cached['geometry'] = cached['geometry'].apply(lambda x: wkt.loads(x) if isinstance(x, str) else None)
+        cached['geometry'] = decode_geometries(cached['geometry'])
         cached = cached.rename(columns={'geometry': 'isochrone'})
         cached = gpd.GeoDataFrame(cached, crs='EPSG:4326', geometry='isochrone')
         cached['cache_avail'] = True
@@ -79,9 +385,7 @@ class Isochrones:
         batch = batch.set_index('uid')
         
         logging.debug("Finding isochrones from cache..")
-        with self.con:
-            qry = f"SELECT uid FROM isochrone WHERE city_id='{city_id}'"
-            cached = pd.read_sql_query(qry, self.con)
+        cached = self._query_batch(city_id, batch, ['uid'])
         
         cached['cache_avail'] = True
         result = batch.merge(cached, how='left', on='uid')
@@ -90,38 +394,67 @@ class Isochrones:
         return result
     
     def _save_cache(self, item, polygon):
-        """Saves cache with multipolygon in a SQLite database."""
-        polygon = gpd.GeoSeries([polygon], crs='EPSG:4326')
-        if polygon.iloc[0].area > 0.0001:
-            polygon = polygon.to_crs(polygon.estimate_utm_crs()).simplify(100).to_crs('EPSG:4326')
-        polygon = polygon.iloc[0].wkt
-        try:
-            with self.con:
-                sql = """
-                    INSERT INTO isochrone (uid, city_id, pid, pt_lat, pt_lon, tt_mnts, dep_dt, mode, source, geometry)
-                    values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """
-                result = self.con.execute(sql, (
-                    item.uid, 
-                    item.city_id,
-                    item.pid,
-                    item.startpt.y,
-                    item.startpt.x,
-                    item.tt_mnts, 
-                    item.dep_dt.to_pydatetime(), 
-                    item['trmode'],
-                    item.source,
-                    polygon))
-        except sl.IntegrityError:
-            raise sl.IntegrityError(f"Constraint failed, check above with UID '{item.uid}'")
-        
-        return result
+        """Saves multipolygon to the SQLite cache, buffered by the writer until its next flush."""
+        self.writer.add(item, polygon)
     
-    def nearest(self, point):
+    def nearest(self, point, fallback=True):
+        """Snaps a point to the nearest road, returning the point itself (or None without fallback) if unresolved."""
         url = f"{self.graphhopper_url}/nearest"
-        response = requests.request("GET", url, params={"point": f"{point.y},{point.x}"}).json()
+        response = self.session.get(url, params={"point": f"{point.y},{point.x}"}).json()
+        if not 'coordinates' in response:
+            logging.warning(f"GH Nearest no resolve: {response}")
+            return point if fallback else None
         coords = response['coordinates']
         return Point(coords[0], coords[1])
+    
+    def snap(self, city_id, points, osm_path):
+        """
+        Snaps points to the nearest road, concurrently and cached per city, point and OSM extract.
+        
+        Args:
+        city_id (str):      City ID to store snapped points under.
+        points (GeoSeries): Origin points in EPSG:4326, pid is their position as in get_isochrones.
+        osm_path (path):    OSM extract loaded in GraphHopper, a newer extract invalidates the cache.
+                            Other origins, e.g. from a regenerated population grid, do as well.
+        
+        Returns:
+        snapped (GeoSeries): Snapped points with the same index as points.
+        """
+        assert isinstance(points, gpd.GeoSeries)
+        assert len(self.graphhopper_url) > 0
+        
+        # Key on the extract's name and modification time, so re-extracting re-snaps. The origins are
+        # hashed into the key too, so a regenerated grid with other cells behind the pids re-snaps as well.
+        osm = os.path.basename(osm_path)
+        if os.path.exists(osm_path):
+            osm = f"{osm}:{int(os.path.getmtime(osm_path))}"
+        origins = np.round(shapely.get_coordinates(points.values.to_numpy()), 7)
+        osm = f"{osm}:{hashlib.sha1(origins.tobytes()).hexdigest()[:12]}"
+        
+        with self.con:
+            qry = "SELECT pid, pt_lat, pt_lon FROM snapped WHERE city_id=? AND osm=?"
+            cached = pd.read_sql_query(qry, self.con, params=(str(city_id), osm), index_col='pid')
+        
+        # Snap missing points with several requests in flight.
+        missing = [pid for pid in range(len(points)) if pid not in cached.index]
+        logging.info(f"Snapping {len(missing)} of {len(points)} points to the road network, rest is cached.")
+        if len(missing) > 0:
+            results = imap_bounded(lambda pid: self.nearest(points.iloc[pid], fallback=False), missing, workers=self.workers)
+            results = list(tqdm(results, total=len(missing)))
+            
+            # Only cache points which were snapped, unresolved ones keep their position and are retried next time.
+            rows = [(str(city_id), pid, osm, pt.y, pt.x) for pid, pt in results if pt is not None]
+            with self.con:
+                self.con.executemany("INSERT OR REPLACE INTO snapped VALUES (?, ?, ?, ?, ?)", rows)
+            unresolved = [pid for pid, pt in results if pt is None]
+            if len(unresolved) > 0:
+                logging.warning(f"Could not snap {len(unresolved)} points, using their original position.")
+            rows += [(str(city_id), pid, osm, points.iloc[pid].y, points.iloc[pid].x) for pid in unresolved]
+            new = pd.DataFrame(rows, columns=['city_id', 'pid', 'osm', 'pt_lat', 'pt_lon']).set_index('pid')
+            cached = pd.concat([cached, new[['pt_lat', 'pt_lon']]])
+        
+        cached = cached.loc[range(len(points))]
+        return gpd.GeoSeries(gpd.points_from_xy(cached.pt_lon, cached.pt_lat), index=points.index, crs='EPSG:4326')
 
     def _get_isochrones_bing(self, to_fetch):
         assert len(self.bing_key) > 0
@@ -187,80 +520,96 @@ class Isochrones:
                 
                 self._save_cache(item, result)
     
-    def _get_isochrones_graphhopper(self, to_fetch):
-
-        # Check if graphhopper url is actually set.
-        assert len(self.graphhopper_url) > 0
+    def _group_buckets(self, to_fetch):
+        """Groups rows sharing (pid, mode, dep_dt) so their time budgets come from one bucketed request.
         
-        iterator = tqdm(to_fetch.iterrows(), total=to_fetch.shape[0], smoothing=0)
-        for pid, item in iterator:
+        GraphHopper splits time_limit into equal buckets, so budgets are served from 
+        buckets of their greatest common divisor, e.g. [10, 25] as 5 buckets of 5 minutes.
+        Transit isochrones and groups needing over MAX_BUCKETS buckets stay one request per row.
+        """
+        groups = []
+        for (_, trmode, _), rows in to_fetch.groupby(['pid', 'trmode', 'dep_dt'], sort=False):
+            items = [item for _, item in rows.sort_values('tt_mnts').iterrows()]
+            tt_mnts = [int(item.tt_mnts) for item in items]
+            step = math.gcd(*tt_mnts)
+            if GH_MODES[trmode] == 'pt' or len(items) == 1 or max(tt_mnts) // step > MAX_BUCKETS:
+                groups += [[item] for item in items]
+            else:
+                groups.append(items)
+        return groups
+    
+    def _request_graphhopper(self, items):
+        """Requests isochrones for rows sharing origin, mode and departure, returning their geometries. Thread-safe."""
+        
+        item = items[-1]
+        tt_mnts = [int(i.tt_mnts) for i in items]
+        step = math.gcd(*tt_mnts)
 
-            # Get timezone estimation adoption so time is in local time, and format date string.
-            dep_dt_str = item.dep_dt.astimezone(pytz.utc).isoformat().replace("+00:00", 'Z')
-            
-            # Translate standardised string to graphhopper version.
-            gh_mode = {
-                "driving_off": 'car_cbr_off',
-                "driving_peak": 'car_cbr_peak',
-                "walking": 'foot',
-                "cycling": 'bike',
-                'transit_off': 'pt',
-                'transit_peak': 'pt',
-                'transit_bike_off': 'pt',
-                'transit_bike_peak': 'pt'
-            }
+        # Get timezone estimation adoption so time is in local time, and format date string.
+        dep_dt_str = item.dep_dt.astimezone(pytz.utc).isoformat().replace("+00:00", 'Z')
 
-            # Set required parameters.
-            endpoint = f'{self.graphhopper_url}/isochrone'
-            params = {
-                'point': f"{item.startpt.y},{item.startpt.x}", # LatLng
-                'time_limit': item.tt_mnts * 60,
-                'profile': gh_mode[item['trmode']]
+        # Set required parameters, asking for all budgets as buckets of the largest one.
+        endpoint = f'{self.graphhopper_url}/isochrone'
+        params = {
+            'point': f"{item.startpt.y},{item.startpt.x}", # LatLng
+            'time_limit': max(tt_mnts) * 60,
+            'profile': GH_MODES[item['trmode']]
+        }
+        if len(items) > 1:
+            params['buckets'] = max(tt_mnts) // step
+            
+        # Extra parameters are necessary if it is a public transport query.
+        if GH_MODES[item['trmode']] == 'pt':
+            assert len(items) == 1 # Buckets are not supported by isochrone-pt.
+            endpoint = f'{self.graphhopper_url}/isochrone-pt'
+            profile = 'bike' if "bike" in item['trmode'] else "foot"
+            params = params | {
+                "pt.access_profile": profile,
+                "pt.egress_profile": profile,
+                "pt.earliest_departure_time": dep_dt_str,
+                "pt.limit_street_time": "PT120M"
+                # "pt.profile": 'true', # Not Supported yet.
+                # "pt.arrive_by": 'false',
+                # "reverse_flow": "false",
+                # 'profile': 'pt',
             }
-                
-            # Extra parameters are necessary if it is a public transport query.
-            if gh_mode[item['trmode']] == 'pt':
-                endpoint = f'{self.graphhopper_url}/isochrone-pt'
-                profile = 'bike' if "bike" in item['trmode'] else "foot"
-                params = params | {
-                    "pt.access_profile": profile,
-                    "pt.egress_profile": profile,
-                    "pt.earliest_departure_time": dep_dt_str,
-                    "pt.limit_street_time": "PT120M"
-                    # "pt.profile": 'true', # Not Supported yet.
-                    # "pt.arrive_by": 'false',
-                    # "reverse_flow": "false",
-                    # 'profile': 'pt',
-                }
+    
+        # Execute query.
+        self.response = response_json = self.session.get(endpoint, params=params).json()
         
-            # Execute query.
-            iterator.set_description(f'Requesting {item.uid}')
-            self.response = response_json = requests.get(endpoint, params=params).json()
-            
-            # If polygons are in the response, calculate area and give some suggestion. 
-            if 'polygons' in response_json:
+        # If polygons are in the response, return the raw ones. Cleaning happens in batches in the CacheWriter.
+        if 'polygons' in response_json:
+            if len(items) == 1:
                 # Check if there are indeed 1 multipolygon in here.
-                result = gpd.GeoDataFrame.from_features(response_json['polygons'], crs="EPSG:4326")
-                assert len(result) == 1
-                
-                # Check area size.
-                result_utm = result.to_crs(result.estimate_utm_crs())
-                area = result_utm.area[0]
-                if os.environ.get('ENVIRON', '') == 'dev' and area < 100:
-                    logging.warning(f"Result for {item.uid} area is small: {area:.1f}m2.")
-                
-                # Remove unneccesary detail and convert back to geometry to be saved.
-                result_utm.geometry = result_utm.buffer(10)
-                result = result_utm.to_crs("EPSG:4326")
-                geometry = result.iloc[0].geometry
-                
-            # If not in the response, give a warning and continue with an empty polygon. 
-            else:
-                logging.warning(self.response)
-                geometry = Polygon()
+                assert len(response_json['polygons']) == 1
+                return [shape(response_json['polygons'][0]['geometry'])]
+            
+            # Bucket b covers everything reachable within (b+1) * step minutes.
+            buckets = {f['properties']['bucket']: f['geometry'] for f in response_json['polygons']}
+            return [shape(buckets[tt // step - 1]) for tt in tt_mnts]
+            
+        # If not in the response, give a warning and continue with empty polygons. 
+        logging.warning(response_json)
+        return [Polygon() for _ in items]
+    
+    def _get_isochrones_graphhopper(self, to_fetch):
+        """Fetches isochrones with at most self.workers requests in flight, saving from this thread only."""
+
+        # Check if graphhopper url is actually set.
+        assert len(self.graphhopper_url) > 0
+        
+        groups = self._group_buckets(to_fetch)
+        logging.info(f"Fetching {len(to_fetch)} isochrones in {len(groups)} requests.")
+        
+        results = imap_bounded(self._request_graphhopper, groups, workers=self.workers)
+        with tqdm(total=to_fetch.shape[0], smoothing=0) as iterator:
+            for items, geometries in results:
+                iterator.set_description(f'Received {items[-1].uid}')
                 
-            # Save cache
-            self._save_cache(item, geometry)
+                # Save cache, SQLite connection is not shared with the workers.
+                for item, geometry in zip(items, geometries):
+                    self._save_cache(item, geometry)
+                iterator.update(len(items))
 
     def get_isochrones(self, city_id, points, config, dry_run=False, dry_run_geometry=False):
         """
@@ -285,29 +634,13 @@ class Isochrones:
         )
         """
         
-        # Input checks
-        batch = []
-        for (pid, point) in enumerate(points):
-            for trmode, tt_mnts_list, dep_dt, source in config:
-                for tt_mnts in tt_mnts_list:
-                    batch.append((pid, point, trmode, tt_mnts, dep_dt, source))
-        batch = gpd.GeoDataFrame(
-            batch, columns=['pid', 'startpt', 'trmode', 'tt_mnts', 'dep_dt', 'source'], 
-            geometry='startpt', crs='EPSG:4326')
-        batch['city_id'] = city_id
-        batch['uid'] = batch.apply(lambda x: f"{x.city_id}-{x.pid}-{x.trmode}-{x.tt_mnts}m-{x.source}", axis=1)
-        
-        # Type checking
-        assert batch.trmode.isin(['driving_off', 'driving_peak', 
-                                  'transit_off', 'transit_peak', 
-                                  'transit_bike_off', 'transit_bike_peak', 
-                                  'walking', 'cycling']).all()
-        assert batch.source.isin(['g', 'b', 'h']).all() # GraphHopper, Bing, Here
+        # Build batch of all requests, checking types.
+        batch = build_batch(city_id, points, config)
         logging.debug(batch.head(15))
         
         # Localised batch to timezone-aware.
-        center = batch.unary_union.centroid
-        tz = TimezoneFinder().timezone_at(lng=center.x, lat=center.y)
+        minx, miny, maxx, maxy = batch.total_bounds
+        tz = TimezoneFinder().timezone_at(lng=(minx + maxx) / 2, lat=(miny + maxy) / 2)
         batch.dep_dt = batch.dep_dt.dt.tz_localize(tz)
         logging.debug(f"Converted batch to timezone {tz}.")
         
@@ -326,13 +659,14 @@ class Isochrones:
                 logging.info("Dry run flag: not fetching unavailable geometry.")
             return batch_cached, (len(batch), len(batch)-len(to_fetch), frac_done)
             
-        # Fetch uncached isochrones
+        # Fetch uncached isochrones, the writer flushes whatever is buffered when done or interrupted.
         bing_fetch = to_fetch[to_fetch.source == 'b']
         grph_fetch = to_fetch[to_fetch.source == 'g']
-        if len(bing_fetch) > 0:
-            self._get_isochrones_bing(bing_fetch)
-        if len(grph_fetch) > 0:
-            self._get_isochrones_graphhopper(grph_fetch)
+        with self.writer:
+            if len(bing_fetch) > 0:
+                self._get_isochrones_bing(bing_fetch)
+            if len(grph_fetch) > 0:
+                self._get_isochrones_graphhopper(grph_fetch)
         
         # To guarantee safety, we only pull out our queries from the (now filled) database.
         result = self._check_caches(city_id, batch)
@@ -397,7 +731,7 @@ def test():
     
     isochrones = isochrone_client.get_isochrones(
         city_id=city.city_id, 
-        points=gdf.centroid.to_crs("EPSG:4326"),
+        points=ExtractCenters.centroids(gdf),
         config=isochrone_config
     )
 
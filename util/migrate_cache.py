@@ -0,0 +1,129 @@
+import os
+import sys
+import argparse
+import logging
+import sqlite3 as sl
+import zlib
+import numpy as np
+import shapely
+from tqdm import tqdm
+
+sys.path.append(os.path.realpath('../'))
+from util.isochrones import Isochrones, SCHEMA_VERSION, encode_ukey
+
+def migrate_wkt_to_wkb(db, compress=False, chunksize=5000):
+    """Converts WKT geometries in an isochrone cache to WKB, in place.
+
+    Works in committed chunks, so an interrupted migration can simply be restarted
+    and continues with the rows which are still WKT.
+
+    Args:
+        db (path): Path to the SQLite cache, e.g. cache.main.v2.db
+        compress (bool): zlib-compress the WKB. Defaults to False.
+        chunksize (int): Rows converted per transaction. Defaults to 5000.
+
+    Returns:
+        int: Number of converted rows.
+    """
+    assert os.path.exists(db)
+    con = sl.connect(db)
+
+    total = con.execute("SELECT count(*) FROM isochrone WHERE typeof(geometry) = 'text'").fetchone()[0]
+    logging.info(f"Converting {total} WKT geometries in {db} to WKB (compress={compress}).")
+
+    converted = 0
+    with tqdm(total=total, unit='rows') as progress:
+        while True:
+            rows = con.execute(
+                "SELECT rowid, geometry FROM isochrone WHERE typeof(geometry) = 'text' LIMIT ?",
+                (chunksize,)).fetchall()
+            if len(rows) == 0:
+                break
+
+            rowids, geometries = zip(*rows)
+            blobs = shapely.to_wkb(shapely.from_wkt(np.array(geometries, dtype=object)))
+            if compress:
+                blobs = [zlib.compress(b) for b in blobs]
+
+            with con:
+                con.executemany("UPDATE isochrone SET geometry = ? WHERE rowid = ?", zip(blobs, rowids))
+            converted += len(rows)
+            progress.update(len(rows))
+
+    con.close()
+    logging.info(f"Converted {converted} rows to WKB.")
+    return converted
+
+def fill_ukeys(db, chunksize=50000):
+    """Fills the compact integer key (see encode_ukey) for rows written before it existed.
+
+    Args:
+        db (path): Path to the SQLite cache, e.g. cache.main.v2.db
+        chunksize (int): Rows updated per transaction. Defaults to 50000.
+
+    Returns:
+        int: Number of filled rows.
+    """
+    assert os.path.exists(db)
+    con = sl.connect(db)
+
+    total = con.execute("SELECT count(*) FROM isochrone WHERE ukey IS NULL").fetchone()[0]
+    logging.info(f"Filling {total} compact uid keys in {db}.")
+
+    filled = 0
+    with tqdm(total=total, unit='rows') as progress:
+        while True:
+            rows = con.execute(
+                "SELECT rowid, city_id, pid, mode, tt_mnts, source FROM isochrone WHERE ukey IS NULL LIMIT ?",
+                (chunksize,)).fetchall()
+            if len(rows) == 0:
+                break
+
+            rowids, city_ids, pids, modes, tt_mnts, sources = zip(*rows)
+            ukeys = encode_ukey(np.array(city_ids, dtype=np.int64), pids, modes, tt_mnts, sources)
+
+            with con:
+                con.executemany("UPDATE isochrone SET ukey = ? WHERE rowid = ?", zip(ukeys.tolist(), rowids))
+            filled += len(rows)
+            progress.update(len(rows))
+
+    con.close()
+    logging.info(f"Filled {filled} keys.")
+    return filled
+
+def migrate(db, compress=False, vacuum=True):
+    """Upgrades a cache to the current schema version, in place. Can be rerun after an interruption.
+
+    Args:
+        db (path): Path to the SQLite cache, e.g. cache.main.v2.db
+        compress (bool): zlib-compress the WKB. Defaults to False.
+        vacuum (bool): Reclaim the freed space afterwards. Defaults to True.
+    """
+    assert os.path.exists(db)
+
+    # Opening the cache once adds missing columns and indices.
+    Isochrones(db=db).con.close()
+
+    changed = migrate_wkt_to_wkb(db, compress=compress)
+    changed += fill_ukeys(db)
+
+    con = sl.connect(db)
+    con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if vacuum and changed > 0:
+        logging.info("Vacuuming to reclaim space, this can take a while for large caches.")
+        con.execute("VACUUM")
+    con.close()
+
+    logging.info(f"Cache is now at schema version {SCHEMA_VERSION}.")
+
+if __name__ == "__main__":
+
+    logging.getLogger().setLevel(logging.INFO) # DEBUG, INFO or WARN
+
+    parser = argparse.ArgumentParser(description="Upgrade an isochrone cache to the current schema version.")
+    parser.add_argument('db', nargs='?', default='../1-data/3-traveltime-cache/cache.main.v2.db')
+    parser.add_argument('--compress', action='store_true', help='zlib-compress the WKB')
+    parser.add_argument('--no-vacuum', action='store_true')
+    args = parser.parse_args()
+
+    migrate(args.db, compress=args.compress, vacuum=not args.no_vacuum)
@@ -0,0 +1,49 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def imap_bounded(func, items, workers=4):
+    """Maps func over items in a thread pool, keeping at most `workers` calls in flight.
+
+    Items are only pulled from the iterable when a slot frees up, so slow consumers
+    apply backpressure instead of queueing the whole batch in memory. Results are
+    yielded in completion order to a single consumer, e.g. the cache writer.
+
+    Args:
+        func (callable): Function to call with each item, typically an HTTP request.
+        items (iterable): Items to process, consumed lazily.
+        workers (int): Maximum number of calls in flight. Defaults to 4.
+
+    Yields:
+        tuple: (item, result) for every item, in order of completion.
+    """
+    assert workers >= 1
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        # Fill up all slots before waiting for the first result.
+        in_flight = {}
+        for item in items:
+            in_flight[executor.submit(func, item)] = item
+            if len(in_flight) >= workers:
+                break
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    # Don't start anything new, let the running calls finish and raise.
+                    logging.error(f"Worker failed, cancelling {len(in_flight)} pending calls.")
+                    for pending in in_flight:
+                        pending.cancel()
+                    raise
+
+                # Refill the freed slot before handing the result over.
+                for next_item in items:
+                    in_flight[executor.submit(func, next_item)] = next_item
+                    break
+
+                yield item, result
@@ -0,0 +1,174 @@
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+
+def compute_reach(isochrones, pop_gdf):
+    """Calculates which population cells every isochrone reaches, in one bulk spatial index query.
+
+    Builds a single STRtree over the population grid and matches all isochrones
+    against it at once, aggregating the matched cells with bincount. Reached cells 
+    are returned as ids (pop_gdf index labels), use ReachGeometry to dissolve them.
+
+    Args:
+        isochrones (GeoSeries): (Buffered) isochrones, in the same CRS as pop_gdf.
+        pop_gdf (GeoDataFrame): Population cells with columns cell_pop and raster_km2.
+
+    Returns:
+        DataFrame: reach_n, reach_km2, reach_pop and reach_ids (int32 arrays), indexed like isochrones.
+    """
+    assert isinstance(isochrones, gpd.GeoSeries)
+    assert isochrones.crs == pop_gdf.crs
+
+    n = len(isochrones)
+    iso_idx, cell_idx = pop_gdf.sindex.query(isochrones.values, predicate='intersects')
+    logging.debug(f"Matched {len(iso_idx)} isochrone-cell pairs for {n} isochrones.")
+
+    reach = pd.DataFrame({
+        'reach_n':   np.bincount(iso_idx, minlength=n),
+        'reach_km2': np.bincount(iso_idx, weights=pop_gdf.raster_km2.values[cell_idx], minlength=n),
+        'reach_pop': np.bincount(iso_idx, weights=pop_gdf.cell_pop.values[cell_idx], minlength=n),
+    }, index=isochrones.index)
+
+    # Group the reached cell ids per isochrone, filled one by one so equal lengths don't become a 2D array.
+    order = np.argsort(iso_idx, kind='stable')
+    ids = pop_gdf.index.values[cell_idx[order]].astype('int32')
+    reach_ids = np.empty(n, dtype=object)
+    for i, group in enumerate(np.split(ids, np.cumsum(reach.reach_n.values)[:-1]) if n > 0 else []):
+        reach_ids[i] = group
+    reach['reach_ids'] = reach_ids
+
+    return reach
+
+class ReachGeometry:
+    """Dissolves reached population cells into geometry on demand.
+
+    Dissolving is the most expensive part of reach, so it's only done when asked 
+    for, and results are kept in an LRU cache keyed by the set of cell ids, as 
+    neighbouring origins and modes often reach exactly the same cells.
+    """
+
+    def __init__(self, pop_gdf, maxsize=1024):
+        self.cells = pop_gdf.geometry
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+
+    @classmethod
+    def from_pickle(cls, pcl_path, crs='EPSG:4326', maxsize=1024):
+        """Loads the population extract that reach was calculated on, e.g. {city_id}.buf15000.res1000.pcl"""
+        pop_gdf = gpd.GeoDataFrame(pd.read_pickle(pcl_path))
+        return cls(pop_gdf.to_crs(crs), maxsize=maxsize)
+
+    def get(self, ids):
+        """Returns the dissolved geometry of a set of cell ids."""
+        ids = np.unique(np.asarray(ids, dtype='int32'))
+        key = ids.tobytes()
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        geometry = shapely.union_all(self.cells.loc[ids].values.to_numpy())
+        self.cache[key] = geometry
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return geometry
+
+    def dissolve(self, reach_ids):
+        """Dissolves a Series of cell id arrays, e.g. the reach_ids column, into a GeoSeries."""
+        return gpd.GeoSeries([self.get(ids) for ids in reach_ids], index=reach_ids.index, crs=self.cells.crs)
+
+def _read_population(tiff_path):
+    """Reads a population extract, returning population with nodata as 0, the valid mask, transform and CRS."""
+    with rasterio.open(tiff_path) as raster:
+        pop = raster.read(1, masked=True)
+        transform, crs = raster.transform, raster.crs
+
+    valid = ~np.ma.getmaskarray(pop)
+    pop = np.where(valid, np.maximum(pop.filled(0), 0), 0).astype('float64')
+    return pop, valid, transform, crs
+
+def compute_reach_raster(isochrones, tiff_path, all_touched=True, stack=False, chunksize=64):
+    """Calculates reach by rasterizing isochrones onto the population raster and summing the masked cells.
+
+    An alternative to compute_reach() for the same extracts, which skips polygonizing
+    the raster. With all_touched, every cell an isochrone touches counts, like the
+    'intersects' predicate. Cell area comes from the (equal-area Mollweide) raster 
+    resolution. Reached cells are returned as ids in row-major order of the valid 
+    cells, which matches the index of the grid extract from ExtractCenters.
+
+    Args:
+        isochrones (GeoSeries): (Buffered) isochrones, reprojected to the raster CRS.
+        tiff_path (path): Population GeoTIFF as written by ExtractCenters.extract_city.
+        all_touched (bool): Count cells touched by the outline too. Defaults to True.
+        stack (bool): Rasterize chunks of isochrones into a 3D stack over the full grid and sum 
+            them in one matrix product, instead of one window per isochrone. Faster for small 
+            grids with many isochrones. Defaults to False.
+        chunksize (int): Isochrones per stack. Defaults to 64.
+
+    Returns:
+        DataFrame: reach_n, reach_km2, reach_pop and reach_ids, indexed like isochrones.
+    """
+    assert isinstance(isochrones, gpd.GeoSeries)
+
+    pop, valid, transform, crs = _read_population(tiff_path)
+    cell_km2 = abs(transform.a * transform.e) / 1e6
+    geometries = isochrones.to_crs(crs).values.to_numpy()
+    n = len(geometries)
+    reach_n, reach_pop = np.zeros(n, dtype='int64'), np.zeros(n, dtype='float64')
+    
+    # Cell id of every valid pixel, -1 elsewhere.
+    cell_ids = np.full(pop.shape, -1, dtype='int32')
+    cell_ids[valid] = np.arange(valid.sum(), dtype='int32')
+    reach_ids = np.empty(n, dtype=object)
+    for i in range(n):
+        reach_ids[i] = np.array([], dtype='int32')
+
+    if stack:
+        weights = np.stack([valid.ravel().astype('float64'), pop.ravel()], axis=1)
+        for start in range(0, n, chunksize):
+            chunk = geometries[start:start + chunksize]
+            masks = np.stack([
+                rasterize([(g, 1)], out_shape=pop.shape, transform=transform, all_touched=all_touched, dtype='uint8')
+                if g is not None and not g.is_empty else np.zeros(pop.shape, dtype='uint8')
+                for g in chunk])
+            sums = masks.reshape(len(chunk), -1).astype('float64') @ weights
+            reach_n[start:start + len(chunk)] = sums[:, 0]
+            reach_pop[start:start + len(chunk)] = sums[:, 1]
+            for k, m in enumerate(masks):
+                reach_ids[start + k] = cell_ids[(m > 0) & valid]
+
+    else:
+        for i, g in enumerate(geometries):
+            if g is None or g.is_empty:
+                continue
+
+            # Only rasterize the part of the grid covering the isochrone.
+            minx, miny, maxx, maxy = g.bounds
+            col0, row0 = ~transform * (minx, maxy)
+            col1, row1 = ~transform * (maxx, miny)
+            row0, col0 = max(int(np.floor(row0)), 0), max(int(np.floor(col0)), 0)
+            row1, col1 = min(int(np.ceil(row1)), pop.shape[0]), min(int(np.ceil(col1)), pop.shape[1])
+            if row1 <= row0 or col1 <= col0:
+                continue
+            
+            window = Window(col0, row0, col1 - col0, row1 - row0)
+            rows, cols = slice(row0, row1), slice(col0, col1)
+            mask = rasterize([(g, 1)], out_shape=(row1 - row0, col1 - col0),
+                             transform=window_transform(window, transform),
+                             all_touched=all_touched, dtype='uint8').astype(bool)
+            reach_n[i] = valid[rows, cols][mask].sum()
+            reach_pop[i] = pop[rows, cols][mask].sum()
+            reach_ids[i] = np.sort(cell_ids[rows, cols][mask & valid[rows, cols]])
+
+    return pd.DataFrame({
+        'reach_n':   reach_n,
+        'reach_km2': reach_n * cell_km2,
+        'reach_pop': reach_pop,
+        'reach_ids': reach_ids,
+    }, index=isochrones.index)
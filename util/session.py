@@ -0,0 +1,46 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class TimeoutSession(requests.Session):
+    """Session which applies a default timeout to every request, so a stuck server can't hang a run."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+def make_session(pool_size=10, retries=5, backoff=0.5, timeout=(5, 300)):
+    """Creates a keep-alive session with retries on connection failures and transient 5xx errors.
+
+    Read timeouts are not retried: a request which took longer than the read timeout
+    (e.g. a heavy /isochrone-pt query) would most likely time out again, so it fails 
+    right away instead of loading the server with the same request several times.
+
+    Args:
+        pool_size (int): Connections kept open per host, should be >= the number of threads using it.
+        retries (int): Total retries before giving up, waiting backoff * 2^n seconds in between.
+        backoff (float): Backoff factor in seconds. Defaults to 0.5.
+        timeout (tuple): Default (connect, read) timeout in seconds. Defaults to (5, 300).
+
+    Returns:
+        TimeoutSession: Session to be shared between calls (and threads).
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,                 # Don't resend requests which timed out or broke off mid-response.
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=None,   # GraphHopper POSTs are idempotent too.
+        raise_on_status=False   # Return the last response, callers check its JSON.
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = TimeoutSession(timeout)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session